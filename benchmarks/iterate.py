@@ -0,0 +1,154 @@
+"""
+Throughput benchmark for :meth:`pyfirmata.Board.iterate`.
+
+Compares the block-read parser and its dispatch table with the per-byte
+``read`` path and handler dict they replaced, by parsing a stream of analog
+and digital messages as sent by a board with six analog pins reporting. Run
+it with ``python benchmarks/iterate.py``, or with
+``python benchmarks/iterate.py capture.bin`` to parse the incoming data of a
+capture made with ``Board.start_recording`` instead.
+"""
+from __future__ import division, print_function
+
+import inspect
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pyfirmata  # NOQA
+from pyfirmata import capture, mockup  # NOQA
+from pyfirmata.boards import BOARDS  # NOQA
+
+MESSAGES = 20000
+
+
+class BufferSerial(object):
+    """A serial stand-in that reads from a fixed bytes buffer."""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.pos = 0
+
+    def read(self, size=1):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def inWaiting(self):
+        return len(self.data) - self.pos
+
+    def close(self):
+        pass
+
+
+def legacy_handlers(board):
+    """The handler dict with wrapped handlers as built by pyFirmata 1.1."""
+    handlers = {}
+    for cmd, func in ((pyfirmata.ANALOG_MESSAGE, board._handle_analog_message),
+                      (pyfirmata.DIGITAL_MESSAGE, board._handle_digital_message),
+                      (pyfirmata.REPORT_VERSION, board._handle_report_version),
+                      (pyfirmata.REPORT_FIRMWARE, board._handle_report_firmware)):
+        def add_meta(f):
+            def decorator(*args, **kwargs):
+                f(*args, **kwargs)
+            decorator.bytes_needed = len(inspect.getfullargspec(f)[0]) - 1
+            return decorator
+        handlers[cmd] = add_meta(func)
+    return handlers
+
+
+def legacy_iterate(board, handlers):
+    """The per-byte ``iterate`` implementation from pyFirmata 1.1."""
+    byte = board.sp.read()
+    if not byte:
+        return
+    data = ord(byte)
+    received_data = []
+    handler = None
+    if data < pyfirmata.START_SYSEX:
+        try:
+            handler = handlers[data & 0xF0]
+        except KeyError:
+            return
+        received_data.append(data & 0x0F)
+        while len(received_data) < handler.bytes_needed:
+            received_data.append(ord(board.sp.read()))
+    elif data == pyfirmata.START_SYSEX:
+        data = ord(board.sp.read())
+        handler = handlers.get(data)
+        if not handler:
+            return
+        data = ord(board.sp.read())
+        while data != pyfirmata.END_SYSEX:
+            received_data.append(data)
+            data = ord(board.sp.read())
+    else:
+        try:
+            handler = handlers[data]
+        except KeyError:
+            return
+        while len(received_data) < handler.bytes_needed:
+            received_data.append(ord(board.sp.read()))
+    try:
+        handler(*received_data)
+    except ValueError:
+        pass
+
+
+def make_stream(count):
+    stream = bytearray()
+    for i in range(count):
+        if i % 7 == 6:
+            stream += bytearray([pyfirmata.DIGITAL_MESSAGE + 1, i % 128, 1])
+        else:
+            stream += bytearray([pyfirmata.ANALOG_MESSAGE + i % 7, i % 128, i % 8])
+    return stream
+
+
+def load_capture(path):
+    with open(path, 'rb') as f:
+        return b''.join(bytes(data) for _, direction, data in capture.read_capture(f.read())
+                        if direction == capture.INCOMING)
+
+
+def make_board(stream):
+    board = mockup.MockupBoard('bench', BOARDS['arduino'])
+    for pin in board.analog:
+        pin.reporting = True
+    board.digital_ports[1].reporting = True
+    board.sp = BufferSerial(stream)
+    return board
+
+
+def run_legacy(stream):
+    board = make_board(stream)
+    handlers = legacy_handlers(board)
+    while board.bytes_available():
+        legacy_iterate(board, handlers)
+
+
+def run_block(stream):
+    board = make_board(stream)
+    while board.bytes_available():
+        board.iterate()
+
+
+def main():
+    if len(sys.argv) > 1:
+        stream = load_capture(sys.argv[1])
+    else:
+        stream = make_stream(MESSAGES)
+    print('{0} bytes'.format(len(stream)))
+    results = []
+    for name, func in (('per-byte', run_legacy), ('block-read', run_block)):
+        best = min(timeit.repeat(lambda: func(stream), number=1, repeat=5))
+        results.append(best)
+        print('{0:>10}: {1:8.1f} ms  {2:10.0f} bytes/s'
+              .format(name, best * 1000, len(stream) / best))
+    print('   speedup: {0:.1f}x'.format(results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+from __future__ import division, unicode_literals
+
+import asyncio
+import os
+import threading
+
+import serial
+
+from .board import Board
+from .pyfirmata import (
+    ANALOG_MAPPING_QUERY, ANALOG_MAPPING_RESPONSE, CAPABILITY_QUERY, CAPABILITY_RESPONSE, INPUT,
+    PIN_STATE_QUERY, PIN_STATE_RESPONSE, QUERY_FIRMWARE, REPORT_FIRMWARE
+)
+
+
+class FirmataProtocol(asyncio.Protocol):
+    """Feeds everything read from the serial port to the board's parser."""
+
+    def __init__(self, board):
+        self.board = board
+
+    def data_received(self, data):
+        self.board._parse(data)
+
+    def connection_lost(self, exc):
+        self.board._connection_lost(exc)
+
+
+class TransportSerial(object):
+    """
+    Stands in for the ``serial.Serial`` instance of a :class:`Board`, so the
+    pins and ports of an :class:`AsyncBoard` write through the event loop.
+    Incoming data is pushed to the parser by :class:`FirmataProtocol`, so
+    there is never anything to read.
+    """
+
+    def __init__(self, serial_port, read_transport, write_transport):
+        self.serial = serial_port
+        self.port = serial_port.port
+        self.read_transport = read_transport
+        self.write_transport = write_transport
+
+    def write(self, data):
+        self.write_transport.write(bytes(data))
+
+    def read(self, size=1):
+        return b''
+
+    def inWaiting(self):
+        return 0
+
+    def close(self):
+        if not self.serial.is_open:
+            return
+        self.read_transport.close()
+        self.write_transport.close()
+        self.serial.close()
+
+
+class PinSamples(object):
+    """Asynchronous iterator over the values received for a pin."""
+
+    def __init__(self, board, pin, maxsize):
+        self.board = board
+        self.pin = pin
+        self.queue = asyncio.Queue(maxsize)
+        board._sample_queues.setdefault(pin, []).append(self.queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    async def aclose(self):
+        queues = self.board._sample_queues.get(self.pin, [])
+        if self.queue in queues:
+            queues.remove(self.queue)
+
+
+class AsyncBoard(Board):
+    """
+    A board driven by an asyncio event loop instead of a thread.
+
+    The serial port is opened by :meth:`open`, which also waits for the
+    firmware to answer and sets up the layout::
+
+        async with AsyncBoard('/dev/ttyACM0') as board:
+            pin = board.get_pin('a:0:i')
+            value = await board.wait_for_change(pin)
+
+    Only works with ports that have a file descriptor, so not on Windows.
+    """
+
+    # Seconds between firmware queries while waiting for the board in open()
+    query_interval = 0.5
+    # Seconds to wait for the capabilities in open(), and how often to ask
+    # again when there is no answer
+    query_timeout = 1
+    query_retries = 2
+
+    def __init__(self, port, layout=None, baudrate=57600, name=None):
+        self._batch_lock = threading.RLock()
+        self._replies_lock = threading.Lock()
+        self._priorities = {}
+        self.port = port
+        self.baudrate = baudrate
+        self.name = name or port
+        self._layout = layout
+        # Futures waiting for a reply, by reply command or (command, pin)
+        self._replies = {}
+        # Futures waiting for a value change, by pin
+        self._change_waiters = {}
+        # Queues of async sample iterators, by pin
+        self._sample_queues = {}
+
+    def __str__(self):
+        return "AsyncBoard {0.name} on {0.port}".format(self)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.exit()
+
+    async def open(self, timeout=10):
+        """
+        Opens the serial port and waits until the firmware reports its name,
+        querying it every ``query_interval`` seconds. Without a layout the
+        layout is set up from a capability query, see ``query_timeout`` and
+        ``query_retries``. Raises an ``IOError`` if no Firmata answers within
+        ``timeout`` seconds, or if the capabilities don't arrive.
+        """
+        loop = asyncio.get_running_loop()
+        serial_port = serial.Serial(self.port, self.baudrate, timeout=0)
+        fd = serial_port.fileno()
+        try:
+            read_transport, _ = await loop.connect_read_pipe(
+                lambda: FirmataProtocol(self), os.fdopen(os.dup(fd), 'rb', buffering=0))
+            write_transport, _ = await loop.connect_write_pipe(
+                asyncio.Protocol, os.fdopen(os.dup(fd), 'wb', buffering=0))
+        except Exception:
+            serial_port.close()
+            raise
+        self.sp = TransportSerial(serial_port, read_transport, write_transport)
+
+        self._set_default_handlers()
+        self.add_cmd_handler(CAPABILITY_RESPONSE, self._handle_report_capability_response)
+        self.add_cmd_handler(ANALOG_MAPPING_RESPONSE, self._handle_analog_mapping_response)
+        self.add_cmd_handler(PIN_STATE_RESPONSE, self._handle_pin_state_response)
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                await self.query_firmware(min(self.query_interval, deadline - loop.time()))
+                break
+            except asyncio.TimeoutError:
+                if loop.time() >= deadline:
+                    self.exit()
+                    raise IOError("No Firmata found on {0}".format(self.port))
+
+        if not self._layout:
+            # Answered before the capabilities, see Board.auto_setup
+            for attempt in range(self.query_retries + 1):
+                self.send_sysex(ANALOG_MAPPING_QUERY, [])
+                try:
+                    await self.query_capabilities(self.query_timeout)
+                    break
+                except asyncio.TimeoutError:
+                    if attempt == self.query_retries:
+                        self.exit()
+                        raise IOError("Board detection failed.")
+        self.setup_layout(self._layout)
+
+    def _connection_lost(self, exc):
+        for waiters in list(self._replies.values()) + list(self._change_waiters.values()):
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(exc or IOError("Connection lost"))
+        self._replies.clear()
+        self._change_waiters.clear()
+
+    async def _query(self, sysex_cmd, data, key, timeout, retries=0):
+        """
+        Sends a sysex query and waits at most ``timeout`` seconds for the
+        reply stored under ``key`` by :meth:`_resolve`. Without a reply the
+        query is sent again at most ``retries`` times, after that an
+        ``asyncio.TimeoutError`` is raised.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._replies.setdefault(key, []).append(future)
+        try:
+            for attempt in range(retries + 1):
+                self.send_sysex(sysex_cmd, data)
+                try:
+                    # Shielded, so a late reply to an earlier send still counts
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    if attempt == retries:
+                        raise
+        finally:
+            waiters = self._replies.get(key, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._replies[key]
+
+    async def query_firmware(self, timeout=1, retries=0):
+        """Returns the firmware name and its version tuple."""
+        return await self._query(QUERY_FIRMWARE, [], REPORT_FIRMWARE, timeout, retries)
+
+    async def query_analog_mapping(self, timeout=1, retries=0):
+        """
+        Returns the analog channel of every pin, None for the pins without
+        one.
+        """
+        return await self._query(ANALOG_MAPPING_QUERY, [], ANALOG_MAPPING_RESPONSE,
+                                 timeout, retries)
+
+    async def query_capabilities(self, timeout=1, retries=0):
+        """Returns the layout built from the capability response."""
+        return await self._query(CAPABILITY_QUERY, [], CAPABILITY_RESPONSE, timeout, retries)
+
+    async def query_pin_state(self, pin, timeout=1, retries=0):
+        """
+        Returns the mode and state the board reports for the digital pin with
+        number ``pin``.
+        """
+        return await self._query(PIN_STATE_QUERY, [pin], (PIN_STATE_RESPONSE, pin),
+                                 timeout, retries)
+
+    async def query_pin_states(self, pins, timeout=1, retries=0):
+        """
+        Queries the mode and state of the digital ``pins`` at once, like
+        :meth:`Board.query_pin_states`. Returns a dict with the ``(mode,
+        state)`` tuple of every pin that answered in time.
+        """
+        async def query(number):
+            try:
+                return await self.query_pin_state(number, timeout, retries)
+            except asyncio.TimeoutError:
+                return None
+
+        numbers = self._pin_numbers(pins)
+        queried = sorted(set(numbers.values()))
+        # The queries are all written before the first reply is waited for
+        states = dict(zip(queried, await asyncio.gather(*map(query, queried))))
+        return dict((pin, states[number]) for pin, number in numbers.items()
+                    if states[number] is not None)
+
+    async def wait_for_change(self, pin, timeout=None):
+        """Waits until the value of ``pin`` changes and returns the new value."""
+        future = asyncio.get_running_loop().create_future()
+        self._change_waiters.setdefault(pin, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._change_waiters.get(pin, [])
+            if future in waiters:
+                waiters.remove(future)
+
+    def samples(self, pin, maxsize=1024):
+        """
+        Returns an asynchronous iterator over every value received for
+        ``pin`` from now on. If the consumer falls more than ``maxsize``
+        values behind, the oldest values are dropped. Call ``aclose`` on the
+        iterator to stop receiving values.
+        """
+        return PinSamples(self, pin, maxsize)
+
+    def _pin_updated(self, pin, old_value):
+        for queue in self._sample_queues.get(pin, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(pin.value)
+        if pin.value != old_value:
+            for future in self._change_waiters.pop(pin, ()):
+                if not future.done():
+                    future.set_result(pin.value)
+
+    # Command handlers
+    def _handle_analog_message(self, pin_nr, lsb, msb):
+        try:
+            pin = self.analog[pin_nr]
+        except IndexError:
+            raise ValueError
+        old_value = pin.value
+        super(AsyncBoard, self)._handle_analog_message(pin_nr, lsb, msb)
+        if pin.reporting:
+            self._pin_updated(pin, old_value)
+
+    def _handle_digital_message(self, port_nr, lsb, msb):
+        try:
+            port = self.digital_ports[port_nr]
+        except IndexError:
+            raise ValueError
+        old_values = [(pin, pin.value) for pin in port.pins.created()]
+        super(AsyncBoard, self)._handle_digital_message(port_nr, lsb, msb)
+        if port.reporting:
+            for pin, old_value in old_values:
+                if pin.mode is INPUT:
+                    self._pin_updated(pin, old_value)
@@ -1,35 +1,118 @@
+import contextlib
+import inspect
+import logging
+import math
+import re
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent import futures
+
+import serial
+
+from . import i2c, pyfirmata
+from .cache import device_id
+from .writer import BLOCK, CONTROL, Scheduler, Writer
+from .pyfirmata import *  # NOQA
+
+log = logging.getLogger(__name__)
+
+# Matches any command byte, used to resynchronize the parser
+COMMAND_BYTE = re.compile(b'[\x80-\xff]')
+# Modes of the letters of a digital pin definition, see ``get_pin``
+PIN_DEF_MODES = {'i': INPUT, 'o': OUTPUT, 'p': PWM, 's': SERVO}
+
+
 class Board(object):
     """The Base class for any board."""
     firmata_version = None
     firmware = None
     firmware_version = None
-    _command_handlers = {}
-    _command = None
-    _stored_data = []
-    _parsing_sysex = False
+    # Dispatch table indexed by command byte, see ``add_cmd_handler``
+    _command_handlers = None
+    # Bytes of an incomplete message, kept until the next ``iterate`` call
+    _pending = b''
+    # Number of bytes thrown away because they were not part of a valid message
+    discarded_bytes = 0
+    # Longest sysex message accepted, longer ones are thrown away
+    max_sysex_size = 4096
+    # Seconds between firmware queries while waiting for the board, see
+    # ``wait_for_firmware``, and between checks for an answer while waiting
+    setup_query_interval = 0.5
+    setup_poll_interval = 0.01
+    # Seconds to wait for the reply to a query, and how often to send it
+    # again when there is none, see ``auto_setup``
+    query_timeout = 1
+    query_retries = 2
+    # Futures waiting for a reply, by reply command or (command, pin)
+    _replies = None
+    # Receive time of the data being parsed and the pin changes found in it
+    _received_at = None
+    _changes = None
+    # Open streams, see ``stream``
+    _streams = ()
+    # Messages waiting to be sent, by key, see ``batch``
+    _batch = None
+    _batch_depth = 0
+    _batch_kept = False
+    # Number of bytes received, and the sampling interval with the target
+    # utilization and limits of ``auto_sampling_interval``
+    bytes_received = 0
+    sampling_interval = DEFAULT_SAMPLING_INTERVAL
+    _sampling_target = None
+    _tune_time = 0
+    _tune_period = 1
+    # Writer thread, see ``start_writer`` and ``start_scheduler``
+    _writer = None
+    baudrate = 57600
+    _auto_flush = None
+    # Pin capabilities and analog mapping from the last responses of the board
+    _capabilities = None
+    _analog_mapping = None
+    # LayoutCache to take the layout from in ``auto_setup``, whether it did,
+    # and the device the layout is cached for
+    layout_cache = None
+    _layout_from_cache = False
+    _cache_device = None
 
-    def __init__(self, port, layout=None, baudrate=57600, name=None, timeout=None):
+    def __init__(self, port, layout=None, baudrate=57600, name=None, timeout=None,
+                 layout_cache=None, setup_timeout=None):
+        self._batch_lock = threading.RLock()
+        # Guards _replies, which the Iterator thread resolves
+        self._replies_lock = threading.Lock()
+        # Priority classes of the scheduler by message key, see set_priority
+        self._priorities = {}
         self.sp = serial.Serial(port, baudrate, timeout=timeout)
-        # Allow 5 secs for Arduino's auto-reset to happen
-        # Alas, Firmata blinks its version before printing it to serial
-        # For 2.3, even 5 seconds might not be enough.
-        # TODO Find a more reliable way to wait until the board is ready
-        self.pass_time(BOARD_SETUP_WAIT_TIME)
+        self.baudrate = baudrate
         self.name = name
         self._layout = layout
+        self.layout_cache = layout_cache
         if not self.name:
             self.name = port
 
-        if layout:
-            self.setup_layout(layout)
-        else:
-            self.auto_setup()
+        # Opening the port resets most Arduinos, so wait until Firmata is up
+        # and answers instead of sleeping for a fixed time
+        self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
+        self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+        if setup_timeout is None:
+            setup_timeout = pyfirmata.BOARD_SETUP_WAIT_TIME
+        try:
+            if setup_timeout:
+                self.wait_for_firmware(setup_timeout)
 
-        # Iterate over the first messages to get firmware data
-        while self.bytes_available():
-            self.iterate()
-        # TODO Test whether we got a firmware name and version, otherwise there
-        # probably isn't any Firmata installed
+            if layout:
+                self.setup_layout(layout)
+            else:
+                self.auto_setup()
+
+            # Iterate over the first messages to get firmware data
+            while self.bytes_available():
+                self.iterate()
+        except Exception:
+            # Nobody gets the board to close the port
+            self.sp.close()
+            raise
 
     def __str__(self):
         return "Board{0.name} on {0.sp.port}".format(self)
@@ -43,18 +126,24 @@ class Board(object):
         self.exit()
 
     def send_as_two_bytes(self, val):
-        self.sp.write(bytearray([val % 128, val >> 7]))
+        self._write(bytearray([val % 128, val >> 7]))
 
     def setup_layout(self, board_layout):
         """
         Setup the Pin instances based on the given board layout.
         """
-        # Create pin instances based on board layout
-        self.analog = []
-        for i in board_layout['analog']:
-            self.analog.append(Pin(self, i))
+        # Create pin instances based on board layout. Pins are created when
+        # they are first used, see _init_pin.
+        self.analog_resolution = board_layout.get('analog_resolution',
+                                                  DEFAULT_ANALOG_RESOLUTION)
+        self._pwm_pins = frozenset(board_layout['pwm'])
+        # Certain ports like Rx/Tx and crystal ports are disabled
+        self._disabled_pins = frozenset(board_layout['disabled'])
+        self._digital_capabilities = self._build_capabilities(board_layout)
+        analog_numbers = board_layout['analog']
+        self.analog = LazyPins(len(analog_numbers),
+                               lambda i: self._init_pin(Pin(self, analog_numbers[i])))
 
-        self.digital = []
         self.digital_ports = []
         for i in range(0, len(board_layout['digital']), 8):
             num_pins = len(board_layout['digital'][i:i + 8])
@@ -62,59 +151,132 @@ class Board(object):
             self.digital_ports.append(Port(self, port_number, num_pins))
 
         # Allow to access the Pin instances directly
-        for port in self.digital_ports:
-            self.digital += port.pins
-
-        # Setup PWM pins
-        for i in board_layout['pwm']:
-            self.digital[i].PWM_CAPABLE = True
+        self.digital = LazyPins(len(board_layout['digital']),
+                                lambda i: self.digital_ports[i // 8].pins[i % 8])
 
-        # Disable certain ports like Rx/Tx and crystal ports
-        for i in board_layout['disabled']:
-            self.digital[i].mode = UNAVAILABLE
+        self._streams = []
+        # Pending I2C reads and continuous reads, by (address, register)
+        self._i2c_reads = {}
+        self._i2c_continuous = {}
 
-        # Create a dictionary of 'taken' pins. Used by the get_pin method
-        self.taken = {'analog': dict(map(lambda p: (p.pin_number, False), self.analog)),
-                      'digital': dict(map(lambda p: (p.pin_number, False), self.digital))}
+        # Flags of 'taken' pins by pin number. Used by the get_pin method
+        self.taken = {'analog': bytearray(len(self.analog)),
+                      'digital': bytearray(len(self.digital))}
 
         self._set_default_handlers()
 
+    def _build_capabilities(self, board_layout):
+        """
+        Returns the supported modes and their resolutions of every digital
+        pin, as dicts shared by the pins with the same capabilities. They
+        come from the capabilities in the layout if it has them, otherwise
+        digital pins support INPUT and OUTPUT, the ``pwm`` pins PWM and the
+        ``servo`` pins (all by default) SERVO.
+        """
+        capabilities = board_layout.get('capabilities')
+        if capabilities:
+            pin_modes = [dict(modes) for modes in capabilities]
+        else:
+            servo_pins = frozenset(board_layout.get('servo', board_layout['digital']))
+            pin_modes = []
+            for pin_nr in range(len(board_layout['digital'])):
+                modes = {INPUT: 1, OUTPUT: 1}
+                if pin_nr in self._pwm_pins:
+                    modes[PWM] = 8
+                if pin_nr in servo_pins:
+                    modes[SERVO] = 14
+                pin_modes.append(modes)
+        shared = {}
+        table = []
+        for pin_nr in range(len(board_layout['digital'])):
+            modes = pin_modes[pin_nr] if pin_nr < len(pin_modes) else {}
+            table.append(shared.setdefault(tuple(sorted(modes.items())), modes))
+        return table
+
+    def _init_pin(self, pin):
+        """Sets up a newly created pin according to the layout."""
+        if pin.type == DIGITAL:
+            pin._capabilities = self._digital_capabilities[pin.pin_number]
+            pin.PWM_CAPABLE = pin.pin_number in self._pwm_pins
+            if pin.pin_number in self._disabled_pins:
+                pin.mode = UNAVAILABLE
+        else:
+            pin.set_value_mode(SCALED)
+        return pin
+
     def _set_default_handlers(self):
         # Setup default handlers for standard incoming commands
         self.add_cmd_handler(ANALOG_MESSAGE, self._handle_analog_message)
         self.add_cmd_handler(DIGITAL_MESSAGE, self._handle_digital_message)
         self.add_cmd_handler(REPORT_VERSION, self._handle_report_version)
         self.add_cmd_handler(REPORT_FIRMWARE, self._handle_report_firmware)
+        self.add_cmd_handler(I2C_REPLY, self._handle_i2c_reply)
+        self.add_cmd_handler(PIN_STATE_RESPONSE, self._handle_pin_state_response)
 
     def auto_setup(self):
         """
-        Automatic setup based on Firmata's "Capability Query"
+        Automatic setup based on Firmata's "Capability Query". If the board
+        has a ``layout_cache`` with a layout for the board and its firmware,
+        that layout is used right away and the response to the query only
+        checks it, whenever the board is iterated next.
         """
         self.add_cmd_handler(CAPABILITY_RESPONSE, self._handle_report_capability_response)
-        self.send_sysex(CAPABILITY_QUERY, [])
-        self.pass_time(0.1)  # Serial SYNC
+        self.add_cmd_handler(ANALOG_MAPPING_RESPONSE, self._handle_analog_mapping_response)
+        if self.layout_cache is not None:
+            # Looked up here, as it lists the serial ports, not in the handler
+            self._cache_device = device_id(self.sp.port)
+        key = self._layout_cache_key()
+        layout = key and self.layout_cache.get(*key)
+        if layout:
+            self._layout_from_cache = True
+            self.setup_layout(layout)
+            self.send_sysex(ANALOG_MAPPING_QUERY, [])
+            self.send_sysex(CAPABILITY_QUERY, [])
+            return
 
-        while self.bytes_available():
-            self.iterate()
+        # The firmware answers in order, so the analog mapping is known when
+        # the capabilities arrive. Firmwares without analog mapping don't
+        # answer, so only the capabilities are waited for, and the mapping
+        # is asked for again with every retry.
+        for attempt in range(self.query_retries + 1):
+            self.send_sysex(ANALOG_MAPPING_QUERY, [])
+            try:
+                layout = self._send_query(CAPABILITY_QUERY, [], CAPABILITY_RESPONSE,
+                                          self.query_timeout, drive=True)
+                break
+            except futures.TimeoutError:
+                if attempt == self.query_retries:
+                    raise IOError("Board detection failed.")
+        self.setup_layout(layout)
 
-        # handle_report_capability_response will write self._layout
-        if self._layout:
-            self.setup_layout(self._layout)
-        else:
-            raise IOError("Board detection failed.")
+    def _layout_cache_key(self):
+        if self._cache_device is None or self.firmware is None:
+            return None
+        return self._cache_device, self.firmware, self.firmware_version
 
     def add_cmd_handler(self, cmd, func):
-        """Adds a command handler for a command."""
-        len_args = len(inspect.getfullargspec(func)[0])
-
-        def add_meta(f):
-            def decorator(*args, **kwargs):
-                f(*args, **kwargs)
-            decorator.bytes_needed = len_args - 1  # exclude self
-            decorator.__name__ = f.__name__
-            return decorator
-        func = add_meta(func)
-        self._command_handlers[cmd] = func
+        """
+        Adds a command handler for a command.
+
+        The handler is stored in a table indexed by command byte together
+        with the number of data bytes it takes, which is derived from its
+        number of positional arguments. Handlers for commands with channel
+        data (``0x80`` to ``0xEF``) get the channel as first argument and are
+        entered for all 16 channels. Sysex handlers (``0x00`` to ``0x7F``) get
+        all data bytes of the message.
+        """
+        if self._command_handlers is None:
+            self._command_handlers = [None] * 256
+        params = inspect.signature(func).parameters.values()
+        positional = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+        bytes_needed = len([p for p in params if p.kind in positional])
+        if cmd < START_SYSEX and cmd >= 0x80:
+            # The channel isn't a data byte
+            entry = (func, bytes_needed - 1)
+            for channel in range(16):
+                self._command_handlers[cmd + channel] = entry
+        else:
+            self._command_handlers[cmd] = (func, bytes_needed)
 
     def get_pin(self, pin_def):
         """
@@ -147,6 +309,12 @@ class Board(object):
         if self.taken[a_d][pin_nr]:
             raise PinAlreadyTakenError('{0} pin {1} is already taken on {2}'
                                        .format(a_d, bits[1], self.name))
+        if a_d == 'digital' and len(bits) > 2:
+            mode = PIN_DEF_MODES.get(bits[2], INPUT)
+            modes = self._digital_capabilities[pin_nr]
+            if modes and mode not in modes:
+                raise IOError('{0} pin {1} does not support mode {2} on {3}'
+                              .format(a_d, bits[1], bits[2], self.name))
         # ok, should be available
         pin = part[pin_nr]
         self.taken[a_d][pin_nr] = True
@@ -161,11 +329,69 @@ class Board(object):
             pin.enable_reporting()
         return pin
 
+    def set_value_mode(self, mode, table=None):
+        """
+        Sets the value mode of all analog pins, see :meth:`Pin.set_value_mode`.
+        """
+        for pin in self.analog:
+            pin.set_value_mode(mode, table)
+
+    def stream(self, pins, maxsize=64, drive=False):
+        """
+        Returns a :class:`Stream` of all values received for ``pins``, in
+        batches per read from the serial port.
+
+        :arg pins: A list of :class:`Pin` instances or pin definitions as
+            accepted by :meth:`get_pin`. Pins given by definition are set up
+            as inputs if the definition has no mode, eg. ``['a:0', 'd:2']``.
+        :arg maxsize: The number of batches that can wait for the consumer
+            before :meth:`iterate` blocks.
+        :arg drive: Let the stream call :meth:`iterate` itself, for use
+            without an :class:`Iterator`.
+        """
+        stream_pins = []
+        for pin in pins:
+            if not isinstance(pin, Pin):
+                bits = pin.split(':')
+                if len(bits) == 2:
+                    bits.append('i')
+                pin = self.get_pin(bits)
+            stream_pins.append(pin)
+        return Stream(self, stream_pins, maxsize, drive)
+
+    def start_recording(self, path):
+        """
+        Appends all data read from and written to the serial port from now on
+        to the capture file at ``path``. It can be played back with
+        :class:`pyfirmata.mockup.ReplaySerial`.
+        """
+        self.stop_recording()
+        self.sp = RecordingSerial(self.sp, path)
+
+    def stop_recording(self):
+        """Stops recording started with :meth:`start_recording`."""
+        if isinstance(self.sp, RecordingSerial):
+            self.sp = self.sp.stop_recording()
+
+    def wait_for_firmware(self, timeout):
+        """
+        Waits until the board reports its firmware,
+        querying the firmware every ``setup_query_interval`` seconds. Returns
+        as soon as the board answers, which is usually well within two
+        seconds of a reset. Raises an ``IOError`` and closes the port if no
+        Firmata answers within ``timeout`` seconds.
+        """
+        interval = min(self.setup_query_interval, timeout)
+        try:
+            self._send_query(QUERY_FIRMWARE, [], REPORT_FIRMWARE, interval,
+                             int(math.ceil(timeout / interval)) - 1, drive=True)
+        except futures.TimeoutError:
+            self.sp.close()
+            raise IOError("No Firmata found on {0}".format(self.sp.port))
+
     def pass_time(self, t):
-        """Non-blocking time-out for ``t`` seconds."""
-        cont = time.time() + t
-        while time.time() < cont:
-            time.sleep(0)
+        """Sleeps for ``t`` seconds."""
+        time.sleep(t)
 
     def send_sysex(self, sysex_cmd, data):
         """
@@ -177,7 +403,194 @@ class Board(object):
         msg = bytearray([START_SYSEX, sysex_cmd])
         msg.extend(data)
         msg.append(END_SYSEX)
-        self.sp.write(msg)
+        self.send(msg)
+
+    def send(self, msg):
+        """
+        Writes the message ``msg`` to the serial port, or adds it to the
+        current batch (see :meth:`batch`) or the queue of the writer thread
+        (see :meth:`start_writer`).
+        """
+        if self._batch is None and self._writer is None:
+            self.sp.write(msg)
+            return
+        key = self._message_key(msg)
+        if self._batch is None:
+            self._write(msg, key)
+            return
+        with self._batch_lock:
+            if self._batch is None:
+                self._write(msg, key)
+                return
+            # A newer message for the same pin replaces the older one in its
+            # place, so it stays in order with mode changes, unless one of
+            # the port's pins changes mode after it. Firmata ignores the bits
+            # of pins that aren't outputs yet.
+            if key is None:
+                key = object()
+            elif key in self._batch and self._mode_changed_after(key):
+                del self._batch[key]
+            self._batch[key] = bytes(msg)
+
+    def _mode_changed_after(self, key):
+        """
+        Tells whether the batch has a mode change for a pin of the digital
+        port message under ``key`` after that message.
+        """
+        if not isinstance(key, int) or key & 0xF0 != DIGITAL_MESSAGE:
+            return False
+        keys = iter(self._batch)
+        for other in keys:
+            if other == key:
+                break
+        return any(isinstance(other, tuple) and other[1] // 8 == key & 0x0F
+                   for other in keys)
+
+    @staticmethod
+    def _message_key(msg):
+        """
+        Returns a key that is the same for messages that replace each other,
+        because they are for the same pin or port, or None.
+        """
+        command = msg[0]
+        if command < START_SYSEX:
+            # Analog, digital and report messages for the same pin or port
+            return command
+        elif command == SET_PIN_MODE:
+            return (command, msg[1])
+        return None
+
+    def _write(self, data, key=None):
+        writer = self._writer
+        if writer is None:
+            self.sp.write(data)
+        else:
+            writer.put(data, key)
+
+    def flush(self):
+        """Writes all messages in the current batch to the serial port."""
+        with self._batch_lock:
+            if self._batch:
+                data = b''.join(self._batch.values())
+                self._batch.clear()
+                self._write(data)
+
+    def start_writer(self, maxsize=256, policy=BLOCK):
+        """
+        Starts a :class:`pyfirmata.writer.Writer` thread that does all writes
+        to the serial port, from a queue of at most ``maxsize`` messages. The
+        ``policy`` for a full queue is ``writer.BLOCK``, ``writer.DROP_OLDEST``
+        or ``writer.COALESCE``. Returns the writer, which has the metrics.
+        """
+        self.stop_writer()
+        self._writer = Writer(self, maxsize, policy)
+        self._writer.start()
+        return self._writer
+
+    def start_scheduler(self, utilization=0.9, default_priority=CONTROL, maxsize=256):
+        """
+        Starts a :class:`pyfirmata.writer.Scheduler` thread that does all
+        writes to the serial port, using at most ``utilization`` of the
+        capacity of the link and writing the messages of the pins with the
+        highest priority (see :meth:`set_priority`) first. Returns the
+        scheduler, which has the metrics.
+        """
+        self.stop_writer()
+        self._writer = Scheduler(self, self.baudrate, utilization, default_priority, maxsize)
+        self._writer.start()
+        return self._writer
+
+    def set_priority(self, pin, priority):
+        """
+        Sets the priority class of the messages for ``pin``, which can also be
+        a :class:`Port`, for :meth:`start_scheduler`: ``writer.SAFETY``,
+        ``writer.CONTROL`` or ``writer.COSMETIC``.
+        """
+        if isinstance(pin, Port):
+            keys = [DIGITAL_MESSAGE + pin.port_number, REPORT_DIGITAL + pin.port_number]
+        elif pin.type == DIGITAL:
+            # Digital values are written per port
+            keys = [DIGITAL_MESSAGE + pin.port.port_number, REPORT_DIGITAL + pin.port.port_number,
+                    (SET_PIN_MODE, pin.pin_number)]
+            if pin.pin_number < 16:
+                keys.append(ANALOG_MESSAGE + pin.pin_number)
+        else:
+            keys = [REPORT_ANALOG + pin.pin_number]
+        for key in keys:
+            self._priorities[key] = priority
+
+    def stop_writer(self):
+        """
+        Writes the queued messages and stops the writer or scheduler thread.
+        """
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.stop()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that collects all messages sent within it and writes
+        them to the serial port at once when it ends::
+
+            with board.batch():
+                for pin in leds:
+                    pin.write(1)
+
+        A message for a pin or port replaces any earlier message of the same
+        kind for it in the batch, so only the last value is sent.
+        """
+        with self._batch_lock:
+            if self._batch is None:
+                self._batch = OrderedDict()
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.flush()
+                    if not self._batch_kept:
+                        self._batch = None
+
+    def auto_flush(self, interval):
+        """
+        Collects all messages in a batch (see :meth:`batch`) that is written
+        every ``interval`` seconds by a background thread. Pass None to stop
+        and write the messages that are left.
+        """
+        if self._auto_flush:
+            self._auto_flush.set()
+            self._auto_flush = None
+            self._keep_batch(False)
+        if interval is None:
+            return
+        self._keep_batch(True)
+        stopped = self._auto_flush = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                self.flush()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _keep_batch(self, keep):
+        """
+        Starts collecting all messages in a batch, also outside of
+        :meth:`batch`, for something else to flush. Stops and writes the
+        batch if ``keep`` is false.
+        """
+        with self._batch_lock:
+            self._batch_kept = keep
+            if keep:
+                if self._batch is None:
+                    self._batch = OrderedDict()
+            else:
+                self.flush()
+                if not self._batch_depth:
+                    self._batch = None
 
     def bytes_available(self):
         return self.sp.inWaiting()
@@ -187,43 +600,158 @@ class Board(object):
         Reads and handles data from the microcontroller over the serial port.
         This method should be called in a main loop or in an :class:`Iterator`
         instance to keep this boards pin values up to date.
+
+        Everything waiting in the serial buffer is read with a single
+        ``read`` and every complete message in it is handled. An incomplete
+        message at the end is kept and finished on a later call.
         """
-        byte = self.sp.read()
-        if not byte:
-            return
-        data = ord(byte)
-        received_data = []
-        handler = None
-        if data < START_SYSEX:
-            # These commands can have 'channel data' like a pin nummber appended.
+        data = self.sp.read(self.sp.inWaiting() or 1)
+        if data:
+            self._parse(data)
+
+    def _parse(self, data):
+        """
+        Handles all complete messages in ``data``, then calls the change
+        callbacks of the pins that changed with one batch of changes each.
+        """
+        self._received_at = now = time.monotonic()
+        self.bytes_received += len(data)
+        self._changes = []
+        try:
+            self._parse_messages(data)
+        finally:
+            self._received_at = None
+        if self._changes:
+            self._dispatch_changes(self._changes)
+        for stream in self._streams:
+            stream._flush()
+        if self._sampling_target is not None and now >= self._tune_time + self._tune_period:
+            self._tune_sampling_interval(now)
+
+    def _parse_messages(self, data):
+        """
+        Handles all complete messages in ``data``, prefixed by whatever was
+        left over from the previous call.
+
+        Data bytes outside of a message are skipped. A message interrupted by
+        a command byte, or a sysex message longer than ``max_sysex_size``, is
+        thrown away and parsing resumes at the next command byte. The number
+        of skipped bytes is added to ``discarded_bytes``.
+        """
+        buf = self._pending + data if self._pending else bytearray(data)
+        handlers = self._command_handlers
+        length = len(buf)
+        discarded = 0
+        i = 0
+        while i < length:
+            byte = buf[i]
+            if byte < 0x80:
+                # Data bytes outside of a message, skip to the next command
+                match = COMMAND_BYTE.search(buf, i)
+                end = match.start() if match else length
+                discarded += end - i
+                i = end
+                continue
+            if byte == START_SYSEX:
+                end = buf.find(END_SYSEX, i + 1)
+                if end == -1:
+                    frame_end = length
+                    match = COMMAND_BYTE.search(buf, i + 1)
+                else:
+                    frame_end = end + 1
+                    match = COMMAND_BYTE.search(buf, i + 1, end)
+                if match:
+                    # Interrupted by another command
+                    discarded += match.start() - i
+                    i = match.start()
+                    continue
+                if frame_end - i > self.max_sysex_size:
+                    discarded += frame_end - i
+                    i = frame_end
+                    continue
+                if end == -1:
+                    break
+                entry = handlers[buf[i + 1]] if end > i + 1 else None
+                start = i + 2
+                i = end + 1
+                if entry is not None:
+                    try:
+                        entry[0](*buf[start:end])
+                    except ValueError:
+                        pass
+                continue
+            entry = handlers[byte]
+            if entry is None:
+                discarded += 1
+                i += 1
+                continue
+            func, size = entry
+            end = i + 1 + size
+            match = COMMAND_BYTE.search(buf, i + 1, end)
+            if match:
+                discarded += match.start() - i
+                i = match.start()
+                continue
+            if end > length:
+                break
             try:
-                handler = self._command_handlers[data & 0xF0]
-            except KeyError:
-                return
-            received_data.append(data & 0x0F)
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sp.read()))
-        elif data == START_SYSEX:
-            data = ord(self.sp.read())
-            handler = self._command_handlers.get(data)
-            if not handler:
-                return
-            data = ord(self.sp.read())
-            while data != END_SYSEX:
-                received_data.append(data)
-                data = ord(self.sp.read())
+                if byte >= START_SYSEX:
+                    func(*buf[i + 1:end])
+                elif size == 2:
+                    # Fast path for analog and digital messages
+                    func(byte & 0x0F, buf[i + 1], buf[i + 2])
+                else:
+                    func(byte & 0x0F, *buf[i + 1:end])
+            except ValueError:
+                pass
+            i = end
+        self._pending = buf[i:]
+        if discarded:
+            self.discarded_bytes += discarded
+
+    def _record_sample(self, pin, raw, value):
+        """
+        Adds a value received for ``pin`` to its buffer and streams.
+        """
+        timestamp = self._received_at or time.monotonic()
+        if pin.buffer is not None:
+            pin.buffer.append(raw, timestamp)
+        for stream in pin._streams:
+            stream._add(pin, value, timestamp)
+            if self._received_at is None:
+                # Not called while parsing, so there is no batch to add it to
+                stream._flush()
+
+    def _pin_changed(self, pin, old_value):
+        """
+        Records a change of the value of ``pin`` received from the board, if
+        there is a callback for it.
+        """
+        if not (pin._change_callbacks or pin.port and pin.port._change_callbacks):
+            return
+        if self._received_at is None:
+            # Not called while parsing, so there is no batch to add it to
+            self._dispatch_changes([PinChange(pin, old_value, pin.value, time.monotonic())])
         else:
+            self._changes.append(PinChange(pin, old_value, pin.value, self._received_at))
+
+    def _dispatch_changes(self, changes):
+        batches = {}
+        for change in changes:
+            callbacks = change.pin._change_callbacks
+            if change.pin.port:
+                callbacks = callbacks + change.pin.port._change_callbacks
+            for callback in callbacks:
+                batches.setdefault(callback, []).append(change)
+        for (callback, executor), batch in batches.items():
+            if executor is not None:
+                executor.submit(callback, batch)
+                continue
             try:
-                handler = self._command_handlers[data]
-            except KeyError:
-                return
-            while len(received_data) < handler.bytes_needed:
-                received_data.append(ord(self.sp.read()))
-        # Handle the data
-        try:
-            handler(*received_data)
-        except ValueError:
-            pass
+                callback(batch)
+            except Exception:
+                # A broken callback shouldn't stop the parser or the others
+                log.exception("Change callback %r failed", callback)
 
     def get_firmata_version(self):
         """
@@ -232,6 +760,286 @@ class Board(object):
         """
         return self.firmata_version
 
+    def set_sampling_interval(self, interval):
+        """
+        Sets the interval in milliseconds at which the firmware reads and
+        reports the analog pins.
+        """
+        interval = int(interval)
+        if not 1 <= interval <= 0x3FFF:
+            raise ValueError("Sampling interval must be from 1 to 16383 ms, not {0}"
+                             .format(interval))
+        self.send_sysex(SAMPLING_INTERVAL, to_two_bytes(interval))
+        self.sampling_interval = interval
+
+    def auto_sampling_interval(self, utilization=0.5, min_interval=10, max_interval=1000,
+                               period=1):
+        """
+        Adapts the sampling interval every ``period`` seconds, so the data
+        received uses about ``utilization`` of the capacity of the serial link
+        at the board's baudrate, and the queues of the streams (see
+        :meth:`stream`) stay at most half full. The interval is kept between
+        ``min_interval`` and ``max_interval`` milliseconds. The interval is
+        only adapted while data is received. Pass None to stop.
+        """
+        self._sampling_target = utilization
+        self._sampling_limits = (min_interval, max_interval)
+        self._tune_period = period
+        self._tune_time = time.monotonic()
+        self._tune_bytes = self.bytes_received
+
+    def _tune_sampling_interval(self, now):
+        rate = (self.bytes_received - self._tune_bytes) / (now - self._tune_time)
+        self._tune_time = now
+        self._tune_bytes = self.bytes_received
+        # How far over its limit the link or the slowest consumer is
+        load = rate / (self.baudrate / 10) / self._sampling_target
+        for stream in self._streams:
+            load = max(load, stream._fill() / 0.5)
+        # The data rate goes down as the interval goes up. Be quick to slow
+        # down and slow to speed up, so it doesn't oscillate.
+        if load > 1:
+            interval = self.sampling_interval * load
+        elif load < 0.5:
+            interval = self.sampling_interval * max(load * 1.5, 0.5)
+        else:
+            return
+        min_interval, max_interval = self._sampling_limits
+        interval = int(round(min(max(interval, min_interval), max_interval)))
+        if interval != self.sampling_interval:
+            self.set_sampling_interval(interval)
+
+    def i2c_config(self, delay=0):
+        """
+        Enables I2C on the board. ``delay`` is the time in microseconds the
+        firmware waits between writing and reading a register, which some
+        devices need.
+        """
+        self.send_sysex(I2C_CONFIG, to_two_bytes(delay))
+
+    def i2c_write(self, address, data, register=None):
+        """
+        Writes the bytes ``data`` to the I2C device at ``address``, to
+        ``register`` if it is given.
+        """
+        data = list(data)
+        if register is not None:
+            data.insert(0, register)
+        self.send_sysex(I2C_REQUEST, i2c.request(address, i2c.I2C_WRITE, data))
+
+    def i2c_read(self, address, register=None, count=1, callback=None, timeout=1):
+        """
+        Reads ``count`` bytes from the I2C device at ``address``, from
+        ``register`` if it is given. Returns a ``concurrent.futures.Future``
+        that gets the :class:`pyfirmata.i2c.I2CReply`. The reply is handled
+        by :meth:`iterate`, which also calls ``callback`` with it. Reads
+        still without a reply after ``timeout`` seconds are given up with a
+        ``concurrent.futures.TimeoutError`` when the next read is made.
+
+        The firmware answers the reads of a device in order, so every reply
+        completes the oldest read it can be for. Reads without a register
+        take any reply from the device, as the firmware puts a dummy
+        register in those.
+        """
+        now = time.monotonic()
+        self._expire_i2c_reads(now)
+        future = futures.Future()
+        self._i2c_reads.setdefault(address, []).append(
+            (future, register, callback, now + timeout))
+        self.send_sysex(I2C_REQUEST, i2c.read_request(address, i2c.I2C_READ, register, count))
+        return future
+
+    def _expire_i2c_reads(self, now):
+        for address, reads in list(self._i2c_reads.items()):
+            pending = []
+            for read in reads:
+                if read[0].done():
+                    continue
+                if read[3] > now:
+                    pending.append(read)
+                else:
+                    read[0].set_exception(futures.TimeoutError(
+                        "No reply from I2C device {0:#x}".format(address)))
+            if pending:
+                self._i2c_reads[address] = pending
+            else:
+                del self._i2c_reads[address]
+
+    def i2c_read_continuously(self, address, register=None, count=1, callback=None,
+                              capacity=1024):
+        """
+        Makes the firmware read ``count`` bytes from the I2C device at
+        ``address`` every sampling interval (see
+        :meth:`set_sampling_interval`) and report them, without a request
+        for every read. Returns a ``collections.deque`` that keeps the last
+        ``capacity`` replies. ``callback`` is called with every reply.
+        Without a register, the replies from the device are kept that no
+        continuous read of their register takes.
+        """
+        replies = deque(maxlen=capacity)
+        self._i2c_continuous[(address, register)] = (replies, callback)
+        self.send_sysex(I2C_REQUEST, i2c.read_request(address, i2c.I2C_READ_CONTINUOUSLY,
+                                                      register, count))
+        return replies
+
+    def i2c_stop_reading(self, address):
+        """Stops the continuous reads from the I2C device at ``address``."""
+        self.send_sysex(I2C_REQUEST, i2c.request(address, i2c.I2C_STOP_READING))
+        for key in [key for key in self._i2c_continuous if key[0] == address]:
+            del self._i2c_continuous[key]
+
+    def query_pin_states(self, pins, timeout=1, retries=0, drive=False):
+        """
+        Queries the mode and state of the digital ``pins``, given as
+        :class:`Pin` instances or pin numbers. All queries are written at
+        once and the responses are collected as they come in, for at most
+        ``timeout`` seconds. The queries without a response are sent again
+        at most ``retries`` times. Returns a dict with the ``(mode, state)``
+        tuple of every pin that answered in time.
+
+        The responses are handled by :meth:`iterate`. With ``drive`` this
+        method calls it itself, for use without an :class:`Iterator`.
+        """
+        numbers = self._pin_numbers(pins)
+        queried = sorted(set(numbers.values()))
+        replies = self._send_queries(
+            [(PIN_STATE_QUERY, [number], (PIN_STATE_RESPONSE, number)) for number in queried],
+            timeout, retries, drive)
+        replies = dict(zip(queried, replies))
+        return dict((pin, replies[number].result()) for pin, number in numbers.items()
+                    if not replies[number].cancelled())
+
+    @staticmethod
+    def _pin_numbers(pins):
+        """Returns the number of every digital pin in ``pins``, by pin."""
+        numbers = {}
+        for pin in pins:
+            if isinstance(pin, Pin):
+                if pin.type != DIGITAL:
+                    raise ValueError("{0} is not a digital pin".format(pin))
+                numbers[pin] = pin.pin_number
+            else:
+                numbers[pin] = pin
+        return numbers
+
+    def reconcile_pin_states(self, states):
+        """
+        Sets the modes and values of the pins to the ``states`` returned by
+        :meth:`query_pin_states`, without sending anything to the board.
+        Values are only taken from output, PWM and servo pins. Pins in a mode
+        the pin can't be set to here, like ANALOG or I2C, are left alone.
+        Returns the pins whose mode or value was different.
+        """
+        changed = []
+        for pin, (mode, state) in states.items():
+            if not isinstance(pin, Pin):
+                pin = self.digital[pin]
+            if pin.mode is UNAVAILABLE or mode not in PIN_DEF_MODES.values():
+                continue
+            if pin._capabilities is not None and mode not in pin._capabilities:
+                continue
+            value = pin.value
+            if mode == OUTPUT:
+                value = state & 1
+                same = pin.value is not None and bool(pin.value) == bool(value)
+            elif mode == PWM:
+                top = (1 << (pin._capabilities or {}).get(PWM, 8)) - 1
+                value = state / top
+                same = pin.value is not None and round(pin.value * top) == state
+            elif mode == SERVO:
+                value = state
+                same = pin.value == state
+            else:
+                same = True
+            if pin.mode == mode and same:
+                continue
+            pin._mode = mode
+            pin.value = value
+            if pin.port:
+                pin.port._value_written(pin)
+                # What the board has is only known for the queried pins
+                pin.port._written_mask = None
+            changed.append(pin)
+        return changed
+
+    def _send_query(self, sysex_cmd, data, key, timeout=1, retries=0, drive=False):
+        """
+        Sends a sysex query and returns its reply, see :meth:`_send_queries`.
+        Raises a ``concurrent.futures.TimeoutError`` if there is none.
+        """
+        reply, = self._send_queries([(sysex_cmd, data, key)], timeout, retries, drive)
+        if reply.cancelled():
+            raise futures.TimeoutError("No reply to sysex command {0:#x} from {1}"
+                                       .format(sysex_cmd, self))
+        return reply.result()
+
+    def _send_queries(self, queries, timeout=1, retries=0, drive=False):
+        """
+        Sends the ``(sysex_cmd, data, key)`` queries at once and waits at
+        most ``timeout`` seconds for their replies, which the handlers of
+        the replies store under ``key`` with :meth:`_resolve`. The queries
+        without a reply are sent again at most ``retries`` times. Returns a
+        ``concurrent.futures.Future`` for every query, which is cancelled if
+        there was no reply. See :meth:`_wait_for_replies` for ``drive``.
+        """
+        pending = [(sysex_cmd, data, key, self._expect(key)) for sysex_cmd, data, key in queries]
+        replies = [future for _, _, _, future in pending]
+        for _ in range(retries + 1):
+            with self.batch():
+                for sysex_cmd, data, _, future in pending:
+                    if not future.done():
+                        self.send_sysex(sysex_cmd, data)
+            self._wait_for_replies(replies, timeout, drive)
+            if all(future.done() for future in replies):
+                break
+        for _, _, key, future in pending:
+            if not future.done():
+                self._forget(key, future)
+                future.cancel()
+        return replies
+
+    def _expect(self, key):
+        """
+        Returns a ``concurrent.futures.Future`` that gets the reply stored
+        under ``key`` by :meth:`_resolve`.
+        """
+        future = futures.Future()
+        with self._replies_lock:
+            if self._replies is None:
+                self._replies = {}
+            self._replies.setdefault(key, []).append(future)
+        return future
+
+    def _forget(self, key, future):
+        with self._replies_lock:
+            waiters = self._replies.get(key, []) if self._replies else []
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._replies[key]
+
+    def _resolve(self, key, result):
+        with self._replies_lock:
+            waiters = self._replies.pop(key, []) if self._replies else []
+        for future in waiters:
+            if not future.done():
+                future.set_result(result)
+
+    def _wait_for_replies(self, replies, timeout, drive=False):
+        """
+        Waits at most ``timeout`` seconds until all futures in ``replies``
+        are done, calling :meth:`iterate` meanwhile if ``drive`` is set.
+        """
+        if not drive:
+            futures.wait(replies, timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not all(future.done() for future in replies) and time.monotonic() < deadline:
+            if self.bytes_available():
+                self.iterate()
+            else:
+                time.sleep(self.setup_poll_interval)
+
     def servo_config(self, pin, min_pulse=544, max_pulse=2400, angle=0):
         """
         Configure a pin as servo with min_pulse, max_pulse and first angle.
@@ -252,23 +1060,44 @@ class Board(object):
 
     def exit(self):
         """Call this to exit cleanly."""
+        if self._auto_flush:
+            self.auto_flush(None)
         # First detach all servo's, otherwise it somehow doesn't want to close...
         if hasattr(self, 'digital'):
-            for pin in self.digital:
-                if pin.mode == SERVO:
-                    pin.mode = OUTPUT
+            for port in self.digital_ports:
+                for pin in port.pins.created():
+                    if pin.mode == SERVO:
+                        pin.mode = OUTPUT
+        self.stop_writer()
         if hasattr(self, 'sp'):
             self.sp.close()
 
     # Command handlers
     def _handle_analog_message(self, pin_nr, lsb, msb):
-        value = round(float((msb << 7) + lsb) / 1023, 4)
+        raw = (msb << 7) + lsb
         # Only set the value if we are actually reporting
         try:
-            if self.analog[pin_nr].reporting:
-                self.analog[pin_nr].value = value
+            # Pins that aren't created yet aren't reporting either
+            pin = self.analog._pins[pin_nr]
         except IndexError:
             raise ValueError
+        if pin is None or not pin.reporting:
+            return
+        table = pin._value_table
+        if table is None:
+            value = raw
+        else:
+            try:
+                value = table[raw]
+            except IndexError:
+                # More bits than the resolution of the table
+                value = table[-1]
+        if pin.buffer is not None or pin._streams:
+            self._record_sample(pin, raw, value)
+        if pin.value != value:
+            old_value = pin.value
+            pin.value = value
+            self._pin_changed(pin, old_value)
 
     def _handle_digital_message(self, port_nr, lsb, msb):
         """
@@ -285,23 +1114,68 @@ class Board(object):
         self.firmata_version = (major, minor)
 
     def _handle_report_firmware(self, *data):
+        if len(data) < 2:
+            raise ValueError
         major = data[0]
         minor = data[1]
         self.firmware_version = (major, minor)
         self.firmware = two_byte_iter_to_str(data[2:])
+        self._resolve(REPORT_FIRMWARE, (self.firmware, self.firmware_version))
 
-    def _handle_report_capability_response(self, *data):
-        charbuffer = []
-        pin_spec_list = []
+    def _handle_analog_mapping_response(self, *data):
+        self._analog_mapping = parse_analog_mapping(data)
+        self._resolve(ANALOG_MAPPING_RESPONSE, self._analog_mapping)
 
-        for c in data:
-            if c == CAPABILITY_RESPONSE:
-                continue
+    def _handle_i2c_reply(self, *data):
+        reply = i2c.parse_reply(data, self._received_at or time.monotonic())
+        address = reply.address
+        # Replies to reads without a register have a dummy register, 0 on
+        # current firmwares and 0xFF on older ones
+        for register in (reply.register, None):
+            continuous = self._i2c_continuous.get((address, register))
+            if continuous:
+                continuous_reply = reply._replace(register=register)
+                continuous[0].append(continuous_reply)
+                self._call_i2c_callback(continuous[1], continuous_reply)
+                break
+        reads = self._i2c_reads.get(address, [])
+        for read in reads:
+            future, register, callback, _ = read
+            # The caller may have cancelled it
+            if not future.done() and register in (None, reply.register):
+                reads.remove(read)
+                if not reads:
+                    del self._i2c_reads[address]
+                reply = reply._replace(register=register)
+                self._call_i2c_callback(callback, reply)
+                future.set_result(reply)
+                break
 
-            charbuffer.append(c)
-            if c == 0x7F:
-                # A copy of charbuffer
-                pin_spec_list.append(charbuffer[:])
-                charbuffer = []
+    def _call_i2c_callback(self, callback, reply):
+        if callback is None:
+            return
+        try:
+            callback(reply)
+        except Exception:
+            # A broken callback shouldn't stop the parser
+            log.exception("I2C callback %r failed", callback)
 
-        self._layout = pin_list_to_board_dict(pin_spec_list)
+    def _handle_pin_state_response(self, *data):
+        if len(data) < 2:
+            raise ValueError
+        pin, mode = data[:2]
+        state = 0
+        for i, byte in enumerate(data[2:]):
+            state |= byte << (7 * i)
+        self._resolve((PIN_STATE_RESPONSE, pin), (mode, state))
+
+    def _handle_report_capability_response(self, *data):
+        if data and data[0] == CAPABILITY_RESPONSE:
+            data = data[1:]
+        self._capabilities = parse_capabilities(data)
+        self._layout = capabilities_to_layout(self._capabilities, self._analog_mapping)
+        key = self._layout_cache_key()
+        if key and self.layout_cache.put(*key, layout=self._layout) and self._layout_from_cache:
+            warnings.warn("The layout of {0} changed since it was cached, reconnect to "
+                          "use the new layout".format(self), RuntimeWarning)
+        self._resolve(CAPABILITY_RESPONSE, self._layout)
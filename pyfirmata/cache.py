@@ -0,0 +1,100 @@
+"""
+On-disk cache of board layouts, so a board that was set up from a capability
+query before can be set up right away the next time it is connected.
+
+Layouts are stored in a JSON file by device, which is the USB serial number
+of the port if it has one and the port name otherwise, together with the
+name and version of the firmware they were queried from. A layout is only
+used for the same firmware, a different firmware replaces it.
+"""
+import json
+import os
+import threading
+
+
+def default_cache_path():
+    """Returns the default location of the cache file."""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'pyfirmata', 'layouts.json')
+
+
+def device_id(port):
+    """
+    Returns the USB serial number of the device on ``port`` if there is one,
+    so the cache follows a board to another port, and ``port`` otherwise.
+    """
+    try:
+        from serial.tools import list_ports
+        for info in list_ports.comports():
+            if info.device == port and info.serial_number:
+                return 'usb:' + info.serial_number
+    except Exception:
+        pass
+    return port
+
+
+class LayoutCache(object):
+    """
+    The layouts of the boards seen before, stored in the JSON file at
+    ``path`` (see :func:`default_cache_path`). Pass it to :class:`Board` as
+    ``layout_cache`` to use it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, device, firmware, firmware_version):
+        """
+        Returns the layout stored for ``device``, or None if there is none
+        or it was stored for another firmware.
+        """
+        with self._lock:
+            entry = self._load().get(device)
+        if entry and entry['firmware'] == firmware and \
+                tuple(entry['firmware_version']) == tuple(firmware_version):
+            return entry['layout']
+        return None
+
+    def put(self, device, firmware, firmware_version, layout):
+        """
+        Stores the layout for ``device`` and its firmware. Returns whether
+        that changed anything.
+        """
+        entry = {
+            'firmware': firmware,
+            'firmware_version': list(firmware_version),
+            # Stored like it is read back, so it can be compared
+            'layout': json.loads(json.dumps(layout)),
+        }
+        with self._lock:
+            entries = self._load()
+            if entries.get(device) == entry:
+                return False
+            entries[device] = entry
+            self._save(entries)
+        return True
+
+    def remove(self, device):
+        """Forgets the layout of ``device``."""
+        with self._lock:
+            entries = self._load()
+            if entries.pop(device, None) is not None:
+                self._save(entries)
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Replace the file at once, so no other process sees half of it
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,81 @@
+"""
+Recording of the raw serial traffic of a board.
+
+A capture file starts with :data:`MAGIC`, followed by one record per chunk of
+data read from or written to the serial port. Every record is a
+:data:`RECORD` header (the ``time.time()`` of the chunk, :data:`INCOMING` or
+:data:`OUTGOING`, and the length of the chunk) followed by the data itself.
+"""
+import struct
+import threading
+import time
+
+MAGIC = b'PYFCAP1\n'
+RECORD = struct.Struct('<dBI')
+INCOMING = 0
+OUTGOING = 1
+
+
+class RecordingSerial(object):
+    """
+    Wraps a serial port and appends everything read from and written to it
+    to a capture file. Any other attribute is taken from the wrapped port.
+    Used by :meth:`Board.start_recording`.
+    """
+
+    def __init__(self, serial, path):
+        self.serial = serial
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        # Reads and writes can come from different threads
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def _record(self, direction, data):
+        with self._lock:
+            self._file.write(RECORD.pack(time.time(), direction, len(data)))
+            self._file.write(data)
+
+    def read(self, size=1):
+        data = self.serial.read(size)
+        if data:
+            self._record(INCOMING, bytes(data))
+        return data
+
+    def write(self, data):
+        self._record(OUTGOING, bytes(data))
+        return self.serial.write(data)
+
+    def stop_recording(self):
+        """Closes the capture file and returns the wrapped serial port."""
+        with self._lock:
+            self._file.close()
+        return self.serial
+
+    def close(self):
+        self.stop_recording()
+        self.serial.close()
+
+
+def read_capture(buf):
+    """
+    Generator over the ``(timestamp, direction, data)`` records of a capture
+    file's contents in ``buf``, which can be a ``mmap``. ``data`` is a
+    memoryview of ``buf``.
+    """
+    if buf[:len(MAGIC)] != MAGIC:
+        raise IOError("Not a pyFirmata capture file")
+    view = memoryview(buf)
+    offset = len(MAGIC)
+    end = len(buf)
+    while offset + RECORD.size <= end:
+        timestamp, direction, length = RECORD.unpack_from(buf, offset)
+        offset += RECORD.size
+        if offset + length > end:
+            # The last record was cut off while recording
+            break
+        yield timestamp, direction, view[offset:offset + length]
+        offset += length
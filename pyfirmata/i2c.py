@@ -0,0 +1,58 @@
+"""
+Encoding and decoding of Firmata's I2C messages, used by the I2C methods of
+:class:`Board`.
+"""
+from collections import namedtuple
+
+# Read/write mode bits of an I2C request
+I2C_WRITE = 0x00
+I2C_READ = 0x08
+I2C_READ_CONTINUOUSLY = 0x10
+I2C_STOP_READING = 0x18
+# Set for 10 bit addresses, of which bits 8 to 10 are in the lowest bits
+I2C_10BIT_ADDRESS = 0x20
+
+# Marks a reply to a read without a register. StandardFirmata and
+# ConfigurableFirmata send a dummy register instead, see
+# Board._handle_i2c_reply
+REGISTER_NOT_SPECIFIED = 0x3FFF
+
+I2CReply = namedtuple('I2CReply', 'address register data timestamp')
+"""
+Data read from the I2C device at ``address``. ``register`` is None if the
+read didn't specify one. ``data`` is a bytes object, ``timestamp`` the
+``time.monotonic()`` at which it was received.
+"""
+
+
+def request(address, mode, data=()):
+    """
+    Returns the data of an I2C_REQUEST sysex message for ``address``, with
+    the 8 bit ``data`` bytes sent as two 7 bit bytes each.
+    """
+    if not 0 <= address <= 0x3FF:
+        raise ValueError("Invalid I2C address {0}".format(address))
+    if address > 0x7F:
+        mode |= I2C_10BIT_ADDRESS | (address >> 7)
+    msg = bytearray([address & 0x7F, mode])
+    for byte in data:
+        msg += bytearray([byte & 0x7F, byte >> 7])
+    return msg
+
+
+def read_request(address, mode, register, count):
+    """Returns the data of an I2C_REQUEST to read ``count`` bytes."""
+    data = [] if register is None else [register]
+    return request(address, mode, data) + bytearray([count & 0x7F, count >> 7])
+
+
+def parse_reply(data, timestamp=None):
+    """Returns the :class:`I2CReply` in the data of an I2C_REPLY message."""
+    if len(data) < 4:
+        raise ValueError
+    address = data[0] | data[1] << 7
+    register = data[2] | data[3] << 7
+    if register == REGISTER_NOT_SPECIFIED:
+        register = None
+    payload = bytes(bytearray(lsb | msb << 7 for lsb, msb in zip(data[4::2], data[5::2])))
+    return I2CReply(address, register, payload, timestamp)
@@ -1,6 +1,10 @@
+import mmap
+import threading
+import time
 from collections import deque
 
 import pyfirmata
+from pyfirmata.capture import INCOMING, read_capture
 
 
 class MockupSerial(deque):
@@ -47,38 +51,121 @@ class MockupSerial(deque):
         return len(self)
 
 
+class ReplaySerial(MockupSerial):
+    """
+    A Mockup object for python's Serial that plays back the incoming data of
+    a capture file made with :meth:`Board.start_recording`. The file is
+    mapped into memory with ``mmap``, so it is never loaded as a whole.
+
+    With ``speed`` the data becomes available at the recorded pace, scaled
+    by ``speed`` (1 is real time). Without it, all data is available at
+    once. Each ``inWaiting`` returns the size of one recorded chunk, so the
+    board sees the data in the same pieces as when it was recorded.
+    Written data is thrown away.
+    """
+
+    def __init__(self, port, baudrate=57600, timeout=None, speed=None):
+        super(ReplaySerial, self).__init__(port, baudrate, timeout)
+        self.timeout = timeout
+        self.speed = speed
+        with open(port, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._records = read_capture(self._mmap)
+        self._chunk = b''
+        self._chunk_time = None
+        self._start = None
+        self._first_time = None
+        self.finished = False
+        self._next_chunk()
+
+    def _next_chunk(self):
+        for timestamp, direction, data in self._records:
+            if direction == INCOMING:
+                self._chunk = bytes(data)
+                self._chunk_time = timestamp
+                if self._first_time is None:
+                    self._first_time = timestamp
+                return
+        self._chunk = b''
+        self.finished = True
+
+    def _due_in(self):
+        """Seconds until the current chunk may be read."""
+        if self.speed is None or self.finished:
+            return 0
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        return (self._chunk_time - self._first_time) / self.speed - (now - self._start)
+
+    def inWaiting(self):
+        if self._due_in() > 0:
+            return 0
+        return len(self._chunk)
+
+    def read(self, count=1):
+        wait = self._due_in()
+        if wait > 0:
+            if self.timeout is not None and wait > self.timeout:
+                time.sleep(self.timeout)
+                return bytearray()
+            time.sleep(wait)
+        data = bytearray()
+        while count > len(data) and self._chunk:
+            take = count - len(data)
+            data += self._chunk[:take]
+            self._chunk = self._chunk[take:]
+            if not self._chunk:
+                self._next_chunk()
+                if self._due_in() > 0:
+                    break
+        return data
+
+    def write(self, value):
+        pass
+
+    def close(self):
+        self._records.close()
+        self._chunk = b''
+        self.finished = True
+        if not self._mmap.closed:
+            self._mmap.close()
+
+
 class MockupBoard(pyfirmata.Board):
 
     def __init__(self, port, layout, values_dict={}):
+        self._batch_lock = threading.RLock()
+        self._replies_lock = threading.Lock()
+        self._priorities = {}
         self.sp = MockupSerial(port, 57600)
         self.setup_layout(layout)
         self.values_dict = values_dict
         self.id = 1
 
     def reset_taken(self):
-        for key in self.taken['analog']:
-            self.taken['analog'][key] = False
-        for key in self.taken['digital']:
-            self.taken['digital'][key] = False
+        for taken in self.taken.values():
+            taken[:] = bytearray(len(taken))
 
     def update_values_dict(self):
+        # The ports and pins of the layout are real ones, only mockups use it
         for port in self.digital_ports:
-            port.values_dict = self.values_dict
-            port.update_values_dict()
-        for pin in self.analog:
-            pin.values_dict = self.values_dict
+            if isinstance(port, MockupPort):
+                port.values_dict = self.values_dict
+                port.update_values_dict()
+        for pin in self.analog.created():
+            if isinstance(pin, MockupPin):
+                pin.values_dict = self.values_dict
 
 
 class MockupPort(pyfirmata.Port):
     def __init__(self, board, port_number):
-        self.board = board
-        self.port_number = port_number
-        self.reporting = False
-
-        self.pins = []
-        for i in range(8):
-            pin_nr = i + self.port_number * 8
-            self.pins.append(MockupPin(self.board, pin_nr, type=pyfirmata.DIGITAL, port=self))
+        super(MockupPort, self).__init__(board, port_number)
+        self.values_dict = {}
+
+    def _create_pin(self, index):
+        return MockupPin(self.board, index + self.port_number * 8, type=pyfirmata.DIGITAL,
+                         port=self, values_dict=self.values_dict)
 
     def update_values_dict(self):
         for pin in self.pins:
@@ -1,21 +1,104 @@
-from .pyfirmata import * # import all definitions
+from collections import namedtuple
+from collections.abc import Sequence
+
+from .pyfirmata import *  # NOQA
+
+PinChange = namedtuple('PinChange', 'pin old_value new_value timestamp')
+"""
+A change of the value of ``pin`` received from the board. ``timestamp`` is
+the ``time.monotonic()`` at which the data containing it was read.
+"""
+
+
+class LazyPins(Sequence):
+    """
+    A sequence of pins that creates every pin with ``factory(index)`` the
+    first time it is accessed. It can be indexed, sliced and iterated like
+    the list of pins it replaces, and compares equal to such a list, but
+    has a fixed length.
+    """
+    __slots__ = ('_pins', '_factory')
+
+    def __init__(self, count, factory):
+        self._pins = [None] * count
+        self._factory = factory
+
+    def __len__(self):
+        return len(self._pins)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._pins)))]
+        pin = self._pins[index]
+        if pin is None:
+            if index < 0:
+                index += len(self._pins)
+            pin = self._pins[index] = self._factory(index)
+        return pin
+
+    def __iter__(self):
+        for i in range(len(self._pins)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, LazyPins)):
+            return len(self) == len(other) and all(a is b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def created(self):
+        """Returns the pins that have been created so far."""
+        return [pin for pin in self._pins if pin is not None]
+
 
 class Pin(object):
     """A Pin representation"""
+    __slots__ = ('board', 'pin_number', 'type', 'port', '_bit', 'PWM_CAPABLE', '_capabilities',
+                 '_pin_mode', 'reporting', 'value', 'buffer', '_value_table',
+                 '_change_callbacks', '_streams')
+
     def __init__(self, board, pin_number, type=ANALOG, port=None):
         self.board = board
         self.pin_number = pin_number
         self.type = type
         self.port = port
+        # Bit of the pin in the masks of its port
+        self._bit = 1 << (pin_number - port.port_number * 8) if port else 0
         self.PWM_CAPABLE = False
+        # Supported modes and their resolutions, None if not known
+        self._capabilities = None
         self._mode = (type == DIGITAL and OUTPUT or INPUT)
         self.reporting = False
         self.value = None
+        self.buffer = None
+        # Maps raw analog values to pin values, None for raw values
+        self._value_table = None
+        self._change_callbacks = ()
+        self._streams = ()
 
     def __str__(self):
         type = {ANALOG: 'Analog', DIGITAL: 'Digital'}[self.type]
         return "{0} pin {1}".format(type, self.pin_number)
 
+    def _get_pin_mode(self):
+        return self._pin_mode
+
+    def _set_pin_mode(self, mode):
+        self._pin_mode = mode
+        if self.port:
+            self.port._mode_changed(self)
+
+    _mode = property(_get_pin_mode, _set_pin_mode)
+    """
+    The mode, set without sending anything to the board. Keeps the masks of
+    the port up to date.
+    """
+
     def _set_mode(self, mode):
         if mode is UNAVAILABLE:
             self._mode = UNAVAILABLE
@@ -24,6 +107,8 @@ class Pin(object):
             raise IOError("{0} can not be used through Firmata".format(self))
         if mode is PWM and not self.PWM_CAPABLE:
             raise IOError("{0} does not have PWM capabilities".format(self))
+        if self._capabilities is not None and mode not in self._capabilities:
+            raise IOError("{0} does not support mode {1}".format(self, mode))
         if mode == SERVO:
             if self.type != DIGITAL:
                 raise IOError("Only digital pins can drive servos! {0} is not"
@@ -34,7 +119,7 @@ class Pin(object):
 
         # Set mode with SET_PIN_MODE message
         self._mode = mode
-        self.board.sp.write(bytearray([SET_PIN_MODE, self.pin_number, mode]))
+        self.board.send(bytearray([SET_PIN_MODE, self.pin_number, mode]))
         if mode == INPUT:
             self.enable_reporting()
 
@@ -54,7 +139,7 @@ class Pin(object):
         if self.type == ANALOG:
             self.reporting = True
             msg = bytearray([REPORT_ANALOG + self.pin_number, 1])
-            self.board.sp.write(msg)
+            self.board.send(msg)
         else:
             self.port.enable_reporting()
             # TODO This is not going to work for non-optimized boards like Mega
@@ -64,16 +149,74 @@ class Pin(object):
         if self.type == ANALOG:
             self.reporting = False
             msg = bytearray([REPORT_ANALOG + self.pin_number, 0])
-            self.board.sp.write(msg)
+            self.board.send(msg)
         else:
             self.port.disable_reporting()
             # TODO This is not going to work for non-optimized boards like Mega
 
+    def set_value_mode(self, mode, table=None):
+        """
+        Sets how received analog values are turned into the pin's value.
+
+        :arg mode: ``SCALED`` (the default) for a float from 0.0 to 1.0,
+            according to the analog resolution of the board. ``RAW`` for the
+            integer sent by the board, which is the fastest. ``CALIBRATED``
+            for ``table[raw]``, where ``table`` is a sequence with a value for
+            every raw value.
+        """
+        if mode == SCALED:
+            self._value_table = scale_table(self.board.analog_resolution)
+        elif mode == RAW:
+            self._value_table = None
+        elif mode == CALIBRATED:
+            if not table:
+                raise ValueError("CALIBRATED mode needs a calibration table")
+            self._value_table = table
+        else:
+            raise ValueError("Unknown value mode {0}".format(mode))
+
+    def enable_buffer(self, capacity=1024):
+        """
+        Starts recording every value received for the pin, with its receive
+        time, in a :class:`pyfirmata.util.SampleBuffer` of ``capacity``
+        samples. Analog values are stored raw, digital values as 0 or 1.
+        Returns the buffer, which is also available as ``pin.buffer``.
+        """
+        self.buffer = SampleBuffer(capacity)
+        self._sampling_changed()
+        return self.buffer
+
+    def disable_buffer(self):
+        """Stops recording values."""
+        self.buffer = None
+        self._sampling_changed()
+
+    def _sampling_changed(self):
+        if self.port:
+            self.port._sampling_changed(self)
+
+    def subscribe(self, callback, executor=None):
+        """
+        Calls ``callback`` when the value of the pin changes.
+
+        The callback gets a list of :class:`PinChange` tuples, with all
+        changes found in one read from the serial port. It is called from
+        :meth:`Board.iterate`, so it should be quick. Pass a
+        ``concurrent.futures`` executor as ``executor`` to call it there
+        instead.
+        """
+        self._change_callbacks += ((callback, executor),)
+
+    def unsubscribe(self, callback):
+        """Removes a callback added with :meth:`subscribe`."""
+        self._change_callbacks = tuple(c for c in self._change_callbacks if c[0] != callback)
+
     def read(self):
         """
         Returns the output value of the pin. This value is updated by the
-        boards :meth:`Board.iterate` method. Value is always in the range from
-        0.0 to 1.0.
+        boards :meth:`Board.iterate` method. For analog pins the value is in
+        the range from 0.0 to 1.0, unless another mode is set with
+        :meth:`set_value_mode`.
         """
         if self.mode == UNAVAILABLE:
             raise IOError("Cannot read pin {0}".format(self.__str__()))
@@ -95,17 +238,20 @@ class Pin(object):
                           .format(self))
         if value is not self.value:
             self.value = value
+            if self.port:
+                self.port._value_written(self)
             if self.mode is OUTPUT:
                 if self.port:
-                    self.port.write()
+                    self.port._write_changed()
                 else:
                     msg = bytearray([DIGITAL_MESSAGE, self.pin_number, value])
-                    self.board.sp.write(msg)
+                    self.board.send(msg)
             elif self.mode is PWM:
-                value = int(round(value * 255))
+                resolution = self._capabilities.get(PWM, 8) if self._capabilities else 8
+                value = int(round(value * ((1 << resolution) - 1)))
                 msg = bytearray([ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7])
-                self.board.sp.write(msg)
+                self.board.send(msg)
             elif self.mode is SERVO:
                 value = int(value)
                 msg = bytearray([ANALOG_MESSAGE + self.pin_number, value % 128, value >> 7])
-                self.board.sp.write(msg)
+                self.board.send(msg)
@@ -1,14 +1,41 @@
+from .pyfirmata import *  # NOQA
+
+
 class Port(object):
     """An 8-bit port on the board."""
+    __slots__ = ('board', 'port_number', 'reporting', 'pins', '_change_callbacks',
+                 '_output_pins', '_input_pins', '_high_pins', '_written_mask', '_stale_pins',
+                 '_sampled_pins', 'mask', 'changed_mask')
+
     def __init__(self, board, port_number, num_pins=8):
         self.board = board
         self.port_number = port_number
         self.reporting = False
+        self._change_callbacks = ()
 
-        self.pins = []
-        for i in range(num_pins):
-            pin_nr = i + self.port_number * 8
-            self.pins.append(Pin(self.board, pin_nr, type=DIGITAL, port=self))
+        # Bitmasks of the pins in OUTPUT and in INPUT mode, of the pins last
+        # written a value of 1, and of the mask last sent by ``write``.
+        # Digital pins start as outputs.
+        self._output_pins = (1 << num_pins) - 1
+        self._input_pins = 0
+        self._high_pins = 0
+        self._written_mask = None
+        # Bitmasks of the input pins whose value has to be set by the next
+        # ``_update`` even if their bit doesn't change, and of the pins that
+        # record every value in a buffer or stream
+        self._stale_pins = 0xFF
+        self._sampled_pins = 0
+        # The last mask received from the board, and the bits of the input
+        # pins that changed with it
+        self.mask = None
+        self.changed_mask = 0
+
+        # Pins are created when they are first used
+        self.pins = LazyPins(num_pins, self._create_pin)
+
+    def _create_pin(self, index):
+        pin = Pin(self.board, index + self.port_number * 8, type=DIGITAL, port=self)
+        return self.board._init_pin(pin)
 
     def __str__(self):
         return "Digital Port {0.port_number} on {0.board}".format(self)
@@ -17,9 +44,9 @@ class Port(object):
         """Enable reporting of values for the whole port."""
         self.reporting = True
         msg = bytearray([REPORT_DIGITAL + self.port_number, 1])
-        self.board.sp.write(msg)
+        self.board.send(msg)
 
-        for pin in self.pins:
+        for pin in self.pins.created():
             if pin.mode == INPUT:
                 pin.reporting = True  # TODO Shouldn't this happen at the pin?
 
@@ -27,26 +54,83 @@ class Port(object):
         """Disable the reporting of the port."""
         self.reporting = False
         msg = bytearray([REPORT_DIGITAL + self.port_number, 0])
-        self.board.sp.write(msg)
+        self.board.send(msg)
 
     def write(self):
         """Set the output pins of the port to the correct state."""
-        mask = 0
-        for pin in self.pins:
-            if pin.mode == OUTPUT:
-                if pin.value == 1:
-                    pin_nr = pin.pin_number - self.port_number * 8
-                    mask |= 1 << int(pin_nr)
-#        print("type mask", type(mask))
-#        print("type self.portnumber", type(self.port_number))
-#        print("type pinnr", type(pin_nr))
+        mask = self._high_pins & self._output_pins
+        self._written_mask = mask
         msg = bytearray([DIGITAL_MESSAGE + self.port_number, mask % 128, mask >> 7])
-        self.board.sp.write(msg)
+        self.board.send(msg)
+
+    def _write_changed(self):
+        """
+        Writes the port for a changed pin value, unless the state of the
+        port is the same as when it was last written.
+        """
+        if self._high_pins & self._output_pins != self._written_mask:
+            self.write()
+
+    def _mode_changed(self, pin):
+        bit = pin._bit
+        output_pins = self._output_pins
+        if pin._mode == OUTPUT:
+            self._output_pins |= bit
+        else:
+            self._output_pins &= ~bit
+        if self._output_pins != output_pins:
+            # The board may have changed the output of the pin
+            self._written_mask = None
+        if pin._mode == INPUT:
+            self._input_pins |= bit
+            self._stale_pins |= bit
+        else:
+            self._input_pins &= ~bit
+
+    def _sampling_changed(self, pin):
+        if pin.buffer is not None or pin._streams:
+            self._sampled_pins |= pin._bit
+        else:
+            self._sampled_pins &= ~pin._bit
+
+    def _value_written(self, pin):
+        if pin.value == 1:
+            self._high_pins |= pin._bit
+        else:
+            self._high_pins &= ~pin._bit
+
+    def subscribe(self, callback, executor=None):
+        """
+        Calls ``callback`` when the value of any input pin of the port changes,
+        see :meth:`Pin.subscribe`.
+        """
+        self._change_callbacks += ((callback, executor),)
+
+    def unsubscribe(self, callback):
+        """Removes a callback added with :meth:`subscribe`."""
+        self._change_callbacks = tuple(c for c in self._change_callbacks if c[0] != callback)
 
     def _update(self, mask):
-        """Update the values for the pins marked as input with the mask."""
-        if self.reporting:
-            for pin in self.pins:
-                if pin.mode is INPUT:
-                    pin_nr = pin.pin_number - self.port_number * 8
-                    pin.value = (mask & (1 << pin_nr)) > 0
\ No newline at end of file
+        """
+        Update the values for the pins marked as input with the mask. Only
+        the pins whose bit changed since the last mask are touched, and the
+        pins that record every value.
+        """
+        if not self.reporting:
+            return
+        changed = ((mask ^ (self.mask or 0)) | self._stale_pins) & self._input_pins
+        self._stale_pins = 0
+        self.mask = mask
+        self.changed_mask = changed
+        todo = changed | (self._sampled_pins & self._input_pins)
+        while todo:
+            bit = todo & -todo
+            todo ^= bit
+            pin = self.pins[bit.bit_length() - 1]
+            value = (mask & bit) > 0
+            if pin.buffer is not None or pin._streams:
+                self.board._record_sample(pin, value, value)
+            if pin.value != value:
+                old_value = pin.value
+                pin.value = value
+                self.board._pin_changed(pin, old_value)
@@ -1,15 +1,16 @@
 from __future__ import division, unicode_literals
 
-import inspect
-import time
+# Re-exported for board, pin and port, which import everything from here,
+# and for the users of ``pyfirmata``. ``serial`` is also where tests replace
+# ``serial.Serial``.
+import serial  # noqa: F401
 
-import serial
-
-from .util import pin_list_to_board_dict, to_two_bytes, two_byte_iter_to_str
-from .excepts import PinAlreadyTakenError, InvalidPinDefError, NoInputWarning
-from .port import Port
-from .board import Board
-from .pin import Pin
+from .capture import RecordingSerial  # noqa: F401
+from .util import (  # noqa: F401
+    SampleBuffer, capabilities_to_layout, parse_analog_mapping, parse_capabilities,
+    pin_list_to_board_dict, scale_table, to_two_bytes, two_byte_iter_to_str
+)
+from .excepts import PinAlreadyTakenError, InvalidPinDefError, NoInputWarning  # noqa: F401
 
 # Message command bytes (0x80(128) to 0xFF(255)) - straight from Firmata.h
 DIGITAL_MESSAGE = 0x90      # send data for a digital pin
@@ -58,10 +59,29 @@ OUTPUT = 1         # as defined in wiring.h
 ANALOG = 2         # analog pin in analogInput mode
 PWM = 3            # digital pin in PWM output mode
 SERVO = 4          # digital pin in SERVO mode
+I2C = 6            # pin included in I2C setup
 
 # Pin types
 DIGITAL = OUTPUT   # same as OUTPUT below
 # ANALOG is already defined above
 
-# Time to wait after initializing serial, used in Board.__init__
-BOARD_SETUP_WAIT_TIME = 5
\ No newline at end of file
+# Analog value modes, see Pin.set_value_mode
+SCALED = 0         # float from 0.0 to 1.0
+RAW = 1            # integer as sent by the board
+CALIBRATED = 2     # looked up in a calibration table
+
+# Analog resolution in bits, when the layout doesn't specify it
+DEFAULT_ANALOG_RESOLUTION = 10
+
+# Sampling interval of the firmware in milliseconds until it is set
+DEFAULT_SAMPLING_INTERVAL = 19
+
+# Maximum time to wait for the firmware to answer after opening the serial
+# port, used in Board.__init__. 0 skips waiting.
+BOARD_SETUP_WAIT_TIME = 5
+
+# The classes import the definitions above, so they have to come last
+from .pin import LazyPins, Pin, PinChange  # NOQA
+from .port import Port  # NOQA
+from .stream import Sample, Stream  # NOQA
+from .board import Board  # NOQA
@@ -0,0 +1,191 @@
+"""
+Keeps many boards up to date from a single thread.
+"""
+import os
+import selectors
+import threading
+import time
+from collections import namedtuple
+
+import serial
+
+BoardHealth = namedtuple('BoardHealth', 'connected last_received bytes_received '
+                                        'discarded_bytes error')
+"""
+The state of a board in a :class:`BoardReactor`. ``last_received`` is the
+``time.monotonic()`` at which data was last read from the board, None if
+nothing was read yet. ``error`` is the exception that made the reactor drop
+the board.
+"""
+
+
+class _BoardState(object):
+    __slots__ = ('connected', 'last_received', 'bytes_received', 'error')
+
+    def __init__(self):
+        self.connected = False
+        self.last_received = None
+        self.bytes_received = 0
+        self.error = None
+
+
+class BoardReactor(threading.Thread):
+    """
+    A thread that keeps a set of boards up to date, instead of an
+    :class:`pyfirmata.util.Iterator` per board.
+
+    The serial ports of all boards are registered with one ``selectors``
+    selector, and the thread only wakes up to read and parse the data of the
+    boards that have some waiting. With ``flush_interval`` it also collects
+    the outgoing messages of every board in a batch (see :meth:`Board.batch`)
+    and writes the batches every ``flush_interval`` seconds, like
+    :meth:`Board.auto_flush` without a thread per board.
+
+    Boards can be added and removed while the reactor runs. A board whose
+    port fails is dropped, :meth:`health` shows why. Needs ports with a
+    ``fileno`` method, so it doesn't work on Windows.
+    """
+
+    # Seconds to block in select when there is nothing to flush
+    select_timeout = 1
+
+    def __init__(self, boards=(), flush_interval=None):
+        super(BoardReactor, self).__init__()
+        self.daemon = True
+        self.flush_interval = flush_interval
+        self._selector = selectors.DefaultSelector()
+        self._states = {}
+        # Boards to add and remove, handled by the reactor thread so the
+        # selector is only used from there
+        self._changes = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Pipe written to by stop() and the changes to wake up select
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        for board in boards:
+            self.add(board)
+
+    def add(self, board):
+        """Starts keeping ``board`` up to date."""
+        with self._lock:
+            self._states[board] = _BoardState()
+            self._changes.append((board, True))
+        if self.flush_interval:
+            board._keep_batch(True)
+        self._wake()
+
+    def remove(self, board):
+        """Stops keeping ``board`` up to date, and writes its last batch."""
+        with self._lock:
+            self._changes.append((board, False))
+        self._wake()
+
+    def health(self, board):
+        """Returns the :class:`BoardHealth` of ``board``."""
+        state = self._states[board]
+        return BoardHealth(state.connected, state.last_received, state.bytes_received,
+                           board.discarded_bytes, state.error)
+
+    @property
+    def boards(self):
+        """The boards that are kept up to date."""
+        with self._lock:
+            return [board for board, state in self._states.items() if state.connected]
+
+    def stop(self):
+        """Ends the thread after the current iteration."""
+        self._stopped.set()
+        self._wake()
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is None:
+            # The thread has ended
+            return
+        try:
+            os.write(wakeup[1], b'\0')
+        except OSError:
+            # The pipe is full, so it will wake up anyway
+            pass
+
+    def _apply_changes(self):
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for board, add in changes:
+            state = self._states.get(board)
+            if add:
+                try:
+                    fd = board.sp.fileno()
+                    if fd in self._selector.get_map():
+                        # Left behind by a board whose port was closed
+                        self._drop(self._selector.get_key(fd).data, IOError("Port closed"))
+                    self._selector.register(fd, selectors.EVENT_READ, board)
+                except (ValueError, KeyError, OSError, AttributeError) as e:
+                    self._drop(board, e)
+                    continue
+                state.connected = True
+            elif state and state.connected:
+                self._drop(board)
+
+    def _drop(self, board, error=None):
+        state = self._states[board]
+        state.connected = False
+        state.error = error
+        for key in list(self._selector.get_map().values()):
+            if key.data is board:
+                self._selector.unregister(key.fileobj)
+        if self.flush_interval:
+            try:
+                board._keep_batch(False)
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                # Nothing can be written to a failed port
+                pass
+
+    def _read(self, board):
+        state = self._states[board]
+        try:
+            data = board.sp.read(board.sp.inWaiting() or 1)
+        except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+            # The port was closed or the device is gone
+            self._drop(board, e)
+            return
+        if data:
+            state.bytes_received += len(data)
+            state.last_received = time.monotonic()
+            board._parse(data)
+
+    def _flush(self):
+        for board in self.boards:
+            try:
+                board.flush()
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                self._drop(board, e)
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            for board in self.boards:
+                self._drop(board)
+            self._selector.close()
+            wakeup, self._wakeup = self._wakeup, None
+            os.close(wakeup[0])
+            os.close(wakeup[1])
+
+    def _run(self):
+        next_flush = time.monotonic()
+        while not self._stopped.is_set():
+            self._apply_changes()
+            timeout = self.select_timeout
+            if self.flush_interval:
+                timeout = max(0, next_flush - time.monotonic())
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    os.read(self._wakeup[0], 512)
+                else:
+                    self._read(key.data)
+            if self.flush_interval and time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_interval
@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import deque, namedtuple
+
+Sample = namedtuple('Sample', 'pin value timestamp')
+"""
+A value received for ``pin``. ``timestamp`` is the ``time.monotonic()`` at
+which the data containing it was read.
+"""
+
+
+class Stream(object):
+    """
+    Iterator over the values received for a set of pins, created by
+    :meth:`Board.stream`.
+
+    Every item is a list of :class:`Sample` tuples, with all samples for the
+    pins found in one read from the serial port. Batches wait in a queue of
+    at most ``maxsize`` batches. When it is full, :meth:`Board.iterate`
+    blocks until the consumer catches up, so the board (and the serial
+    buffer) is slowed down instead of samples getting lost. After
+    ``overflow_timeout`` seconds it gives up and drops the oldest batch,
+    counted in ``dropped``, so a consumer that stopped reading can't hang
+    the board.
+
+    The stream is normally consumed while an :class:`pyfirmata.util.Iterator`
+    keeps the board up to date. With ``drive`` the stream calls
+    :meth:`Board.iterate` itself whenever it has no batch ready.
+
+    Call :meth:`close`, or use the stream as a context manager, to stop
+    receiving samples. Iterating ends after the batches that were queued
+    before.
+    """
+
+    # Seconds a full queue blocks the board before the oldest batch is dropped
+    overflow_timeout = 1
+
+    def __init__(self, board, pins, maxsize=64, drive=False):
+        self.board = board
+        self.pins = pins
+        self.drive = drive
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._batch = []
+        for pin in pins:
+            pin._streams += (self,)
+            pin._sampling_changed()
+        board._streams.append(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            with self._cond:
+                if self._queue:
+                    batch = self._queue.popleft()
+                    self._cond.notify_all()
+                    return batch
+                if self._closed:
+                    raise StopIteration
+                if not self.drive:
+                    self._cond.wait()
+                    continue
+            self.board.iterate()
+
+    next = __next__  # Python 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def samples(self):
+        """Generator over the single samples of the batches."""
+        for batch in self:
+            for sample in batch:
+                yield sample
+
+    def close(self):
+        """
+        Stops adding samples to the stream, and wakes up the threads waiting
+        for it.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for pin in self.pins:
+            if self in pin._streams:
+                pin._streams = tuple(s for s in pin._streams if s is not self)
+                pin._sampling_changed()
+        if self in self.board._streams:
+            self.board._streams.remove(self)
+
+    def _add(self, pin, value, timestamp):
+        self._batch.append(Sample(pin, value, timestamp))
+
+    def _flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        with self._cond:
+            deadline = None
+            while 0 < self.maxsize <= len(self._queue) and not self._closed:
+                if deadline is None:
+                    deadline = time.monotonic() + self.overflow_timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                return
+            self._queue.append(batch)
+            self._cond.notify_all()
+
+    def _fill(self):
+        """Returns the part of the queue that is used, 0 without a limit."""
+        return len(self._queue) / self.maxsize if self.maxsize > 0 else 0
+
+
+def windows(samples, size, step=None):
+    """
+    Generator over lists of ``size`` consecutive items from ``samples``,
+    starting every ``step`` items (``size`` by default).
+    """
+    step = step or size
+    window = []
+    skip = 0
+    for sample in samples:
+        if skip:
+            # The items between windows when ``step`` is larger than ``size``
+            skip -= 1
+            continue
+        window.append(sample)
+        if len(window) == size:
+            yield window
+            window = window[step:]
+            skip = max(step - size, 0)
@@ -1,15 +1,93 @@
 from __future__ import division, unicode_literals
 
+import glob
+import hashlib
+import json
 import os
+import select
 import sys
 import threading
 import time
+from array import array
+from collections import namedtuple
+from concurrent import futures
 
 import serial
 
 from .boards import BOARDS
 
 
+FoundBoard = namedtuple('FoundBoard', 'board firmware firmware_version fingerprint')
+"""
+A board found by :func:`find_boards`, with the name and version of its
+firmware and the :func:`layout_fingerprint` of its layout.
+"""
+
+
+def layout_fingerprint(layout):
+    """
+    Returns a short hex digest of a board layout, which is the same for
+    boards with the same capabilities.
+    """
+    data = json.dumps(layout, sort_keys=True, default=list).encode('ascii')
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def find_boards(base_dir="/dev/", identifier="tty.usbserial", pattern=None, layout=None,
+                timeout=5, max_workers=16, **kwargs):
+    """
+    Opens a :class:`Board` on every device in ``base_dir`` whose name starts
+    with ``identifier``, or on every path matching the glob ``pattern``, and
+    returns a list of :class:`FoundBoard` tuples for the ones that answered.
+
+    The devices are probed at the same time in a pool of ``max_workers``
+    threads. Each has ``timeout`` seconds to answer. Without a ``layout`` the
+    boards are set up from a capability query. Other keyword arguments are
+    passed to :class:`Board`.
+    """
+    from .pyfirmata import Board  # prevent a circular import
+
+    if pattern:
+        devices = sorted(glob.glob(pattern))
+    else:
+        devices = [os.path.join(base_dir, device) for device in sorted(os.listdir(base_dir))
+                   if device.startswith(identifier)]
+
+    def probe(device):
+        try:
+            board = Board(device, layout, setup_timeout=timeout, **kwargs)
+        except Exception:
+            # Not a board, or one that failed to set up. Board closes the port.
+            return None
+        try:
+            return FoundBoard(board, board.firmware, board.firmware_version,
+                              layout_fingerprint(board._layout))
+        except Exception:
+            board.exit()
+            return None
+
+    if not devices:
+        return []
+    with futures.ThreadPoolExecutor(min(max_workers, len(devices))) as executor:
+        probes = [executor.submit(probe, device) for device in devices]
+    found = []
+    error = None
+    for future in probes:
+        try:
+            result = future.result()
+        except BaseException as e:
+            error = error or e
+            continue
+        if result:
+            found.append(result)
+    if error is not None:
+        # Don't leave the boards that were found open
+        for result in found:
+            result.board.exit()
+        raise error
+    return found
+
+
 def get_the_board(
     layout=BOARDS["arduino"], base_dir="/dev/", identifier="tty.usbserial"
 ):
@@ -19,41 +97,87 @@ def get_the_board(
     overriden by passing a different layout dict as the ``layout`` parameter.
     ``base_dir`` and ``identifier`` are overridable as well. It will raise an
     IOError if it can't find a board, on a serial, or if it finds more than
-    one.
+    one. See :func:`find_boards` to get all boards.
     """
-    from .pyfirmata import Board  # prevent a circular import
-
-    boards = []
-    for device in os.listdir(base_dir):
-        if device.startswith(identifier):
-            try:
-                board = Board(os.path.join(base_dir, device), layout)
-            except serial.SerialException:
-                pass
-            else:
-                boards.append(board)
+    boards = find_boards(base_dir, identifier, layout=layout)
     if len(boards) == 0:
         raise IOError(
             "No boards found in {0} with identifier {1}".format(base_dir, identifier)
         )
     elif len(boards) > 1:
+        for found in boards:
+            found.board.exit()
         raise IOError("More than one board found!")
-    return boards[0]
+    return boards[0].board
 
 
 class Iterator(threading.Thread):
+    """
+    A thread that keeps calling :meth:`Board.iterate` on ``board``.
 
-    def __init__(self, board):
+    By default it checks for incoming data every millisecond. With
+    ``use_select`` it blocks in ``select`` on the file descriptor of the
+    serial port instead and only wakes up when data arrives. That needs a
+    port with a ``fileno`` method, so it doesn't work on Windows.
+
+    Call :meth:`stop` to end the thread. It also ends when the serial port is
+    closed by ``board.exit()``.
+    """
+
+    # Seconds to block in select before checking whether the port is still open
+    select_timeout = 1
+
+    def __init__(self, board, use_select=False):
         super(Iterator, self).__init__()
         self.board = board
         self.daemon = True
+        self.use_select = use_select
+        self._stopped = threading.Event()
+        # Pipe written to by stop() to wake up select, open while the thread
+        # runs with use_select
+        self._wakeup = None
+        self._wakeup_lock = threading.Lock()
+
+    def stop(self):
+        """Ends the thread after the current iteration."""
+        self._stopped.set()
+        with self._wakeup_lock:
+            if self._wakeup is None:
+                return
+            try:
+                os.write(self._wakeup[1], b'\0')
+            except OSError:
+                # The pipe is full, so select wakes up anyway
+                pass
+
+    def _wait_for_data(self):
+        """Blocks until the serial port is readable or stop() is called."""
+        select.select([self.board.sp.fileno(), self._wakeup[0]], [], [],
+                      self.select_timeout)
 
     def run(self):
-        while 1:
+        if self.use_select:
+            with self._wakeup_lock:
+                self._wakeup = os.pipe()
+                os.set_blocking(self._wakeup[1], False)
+        try:
+            self._run()
+        finally:
+            with self._wakeup_lock:
+                wakeup, self._wakeup = self._wakeup, None
+            if wakeup:
+                os.close(wakeup[0])
+                os.close(wakeup[1])
+
+    def _run(self):
+        while not self._stopped.is_set():
             try:
+                if self.use_select:
+                    self._wait_for_data()
                 while self.board.bytes_available():
                     self.board.iterate()
-                time.sleep(0.001)
+                if not self.use_select:
+                    time.sleep(0.001)
             except (AttributeError, serial.SerialException, OSError):
                 # this way we can kill the thread by setting the board object
                 # to None, or when the serial port is closed by board.exit()
@@ -74,6 +198,82 @@ class Iterator(threading.Thread):
                 sys.exit()
 
 
+class SampleBuffer(object):
+    """
+    A fixed size ring buffer of raw values and ``time.monotonic()`` receive
+    timestamps, stored in arrays of ``typecode`` and doubles.
+
+    Every sample is stored twice, ``capacity`` apart, so the last ``n``
+    samples are always contiguous and :meth:`last` can return memoryviews
+    instead of copies.
+    """
+
+    def __init__(self, capacity, typecode='H'):
+        if capacity < 1:
+            raise ValueError("A sample buffer needs a capacity of at least 1")
+        self.capacity = capacity
+        self._values = array(typecode, [0]) * (2 * capacity)
+        self._timestamps = array('d', [0.0]) * (2 * capacity)
+        self._pos = 0
+        # Total number of samples appended
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, value, timestamp):
+        pos = self._pos
+        self._values[pos] = self._values[pos + self.capacity] = value
+        self._timestamps[pos] = self._timestamps[pos + self.capacity] = timestamp
+        self._pos = (pos + 1) % self.capacity
+        self.count += 1
+
+    def clear(self):
+        self._pos = 0
+        self.count = 0
+
+    def last(self, n=None):
+        """
+        Returns memoryviews of the values and timestamps of the last ``n``
+        samples, oldest first. Returns all samples if ``n`` is None. The
+        views show the current data of the buffer, so copy them if they have
+        to outlive the next ``capacity`` samples.
+        """
+        length = len(self)
+        if n is None or n > length:
+            n = length
+        end = self._pos + self.capacity
+        return (memoryview(self._values)[end - n:end],
+                memoryview(self._timestamps)[end - n:end])
+
+    def to_numpy(self, n=None):
+        """
+        Returns copies of the last ``n`` values and timestamps as NumPy
+        arrays. Needs NumPy to be installed.
+        """
+        import numpy
+        values, timestamps = self.last(n)
+        return numpy.array(values), numpy.array(timestamps)
+
+
+_scale_tables = {}
+
+
+def scale_table(resolution):
+    """
+    Returns a tuple that maps every raw value of an analog pin with a
+    resolution of ``resolution`` bits to a float from 0.0 to 1.0, rounded to
+    4 decimals. The tables are shared, so there is one per resolution.
+    """
+    try:
+        return _scale_tables[resolution]
+    except KeyError:
+        top = float(2 ** resolution - 1)
+        table = _scale_tables[resolution] = tuple(round(raw / top, 4)
+                                                  for raw in range(2 ** resolution))
+        return table
+
+
 def to_two_bytes(integer):
     """
     Breaks an integer into two 7 bit bytes.
@@ -158,68 +358,96 @@ def break_to_bytes(value):
     return (c, int(value / c))
 
 
-def pin_list_to_board_dict(pinlist):
+def parse_capabilities(data):
     """
+    Returns the pin capabilities in the data of a capability response, read
+    in one pass: a tuple with a dict for every pin, mapping the modes it
+    supports to their resolution. Pins that can't be used have an empty dict.
+
     Capability Response codes:
         INPUT:  0, 1
         OUTPUT: 1, 1
-        ANALOG: 2, 10
+        ANALOG: 2, 10 (or the resolution of the board)
         PWM:    3, 8
         SERV0:  4, 14
         I2C:    6, 1
     """
+    capabilities = []
+    modes = {}
+    mode = None
+    for byte in data:
+        if byte == 0x7F:
+            # End of the pin
+            capabilities.append(modes)
+            modes = {}
+            mode = None
+        elif mode is None:
+            mode = byte
+        else:
+            modes[mode] = byte
+            mode = None
+    return tuple(capabilities)
+
+
+def parse_analog_mapping(data):
+    """
+    Returns the analog channel of every pin from the data of an analog
+    mapping response, None for the pins without one.
+    """
+    return tuple(None if channel == 0x7F else channel for channel in data)
+
 
-    board_dict = {
+def capabilities_to_layout(capabilities, analog_mapping=None):
+    """
+    Returns the board layout for the pin capabilities from
+    :func:`parse_capabilities`. The analog pins are numbered by their channel
+    from the ``analog_mapping`` of :func:`parse_analog_mapping`, or in the
+    order of the pins without it. The capabilities themselves are in the
+    layout as ``capabilities``, a tuple of ``(mode, resolution)`` pairs for
+    every pin.
+    """
+    layout = {
         "digital": [],
         "analog": [],
         "pwm": [],
-        "servo": [],  # 2.2 specs
-        # 'i2c': [],  # 2.3 specs
+        "servo": [],
+        "i2c": [],
         "disabled": [],
     }
-    for i, pin in enumerate(pinlist):
-        pin.pop()  # removes the 0x79 on end
-        if not pin:
-            board_dict["disabled"] += [i]
-            board_dict["digital"] += [i]
-            continue
-
-        for j, _ in enumerate(pin):
-            # Iterate over evens
-            if j % 2 == 0:
-                # This is safe. try: range(10)[5:50]
-                if pin[j:j + 4] == [0, 1, 1, 1]:
-                    board_dict["digital"] += [i]
+    analog_resolution = None
+    for i, modes in enumerate(capabilities):
+        if 2 in modes:
+            layout["analog"].append(i)
+            analog_resolution = modes[2]
+        elif not modes or 0 in modes or 1 in modes:
+            layout["digital"].append(i)
+        if not modes:
+            layout["disabled"].append(i)
+        if 3 in modes:
+            layout["pwm"].append(i)
+        if 4 in modes:
+            layout["servo"].append(i)
+        if 6 in modes:
+            layout["i2c"].append(i)
+
+    if analog_mapping:
+        layout["analog"] = sorted(analog_mapping[i] for i in layout["analog"]
+                                  if i < len(analog_mapping) and analog_mapping[i] is not None)
+    else:
+        layout["analog"] = range(len(layout["analog"]))
+
+    layout = dict((key, tuple(value)) for key, value in layout.items())
+    layout["capabilities"] = tuple(tuple(sorted(modes.items())) for modes in capabilities)
+    if analog_mapping:
+        layout["analog_mapping"] = tuple(analog_mapping)
+    if analog_resolution:
+        layout["analog_resolution"] = analog_resolution
+    return layout
 
-                if pin[j:j + 2] == [2, 10]:
-                    board_dict["analog"] += [i]
-
-                if pin[j:j + 2] == [3, 8]:
-                    board_dict["pwm"] += [i]
-
-                if pin[j:j + 2] == [4, 14]:
-                    board_dict["servo"] += [i]
-
-                # Desable I2C
-                if pin[j:j + 2] == [6, 1]:
-                    pass
 
-    # We have to deal with analog pins:
-    # - (14, 15, 16, 17, 18, 19)
-    # + (0, 1, 2, 3, 4, 5)
-    diff = set(board_dict["digital"]) - set(board_dict["analog"])
-    board_dict["analog"] = [n for n, _ in enumerate(board_dict["analog"])]
-
-    # Digital pin problems:
-    # - (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15)
-    # + (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
-
-    board_dict["digital"] = [n for n, _ in enumerate(diff)]
-    # Based on lib Arduino 0017
-    board_dict["servo"] = board_dict["digital"]
-
-    # Turn lists into tuples
-    # Using dict for Python 2.6 compatibility
-    board_dict = dict([(key, tuple(value)) for key, value in board_dict.items()])
-
-    return board_dict
+def pin_list_to_board_dict(pinlist):
+    """
+    Returns the board layout for the data of a capability response, split
+    into a list per pin that ends with 0x7F. See :func:`capabilities_to_layout`.
+    """
+    return capabilities_to_layout(parse_capabilities(byte for pin in pinlist for byte in pin))
@@ -0,0 +1,387 @@
+"""
+Writing to the serial port of a board from a background thread.
+"""
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+import serial
+
+# What Writer.put does with a message when the queue is full
+BLOCK = 'block'              # wait until there is room
+DROP_OLDEST = 'drop_oldest'  # drop the oldest message in the queue
+COALESCE = 'coalesce'        # replace the queued message for the same pin, else drop the oldest
+
+WriterStats = namedtuple('WriterStats', 'depth max_depth written dropped coalesced '
+                                        'last_latency max_latency mean_latency')
+"""
+Metrics of a :class:`Writer`. ``depth`` is the number of messages in the
+queue, ``max_depth`` the highest it has been. The latencies are the seconds
+from queueing a message until it was written.
+"""
+
+
+class Writer(threading.Thread):
+    """
+    A thread that writes the messages of a board to its serial port, created
+    by :meth:`Board.start_writer`.
+
+    Messages wait in a queue of at most ``maxsize`` messages, so the threads
+    that send them never wait for the serial port. Every message is written
+    as a whole. The ``policy`` decides what happens when the queue is full:
+    :data:`BLOCK` makes the sender wait, :data:`DROP_OLDEST` drops the oldest
+    message and :data:`COALESCE` drops an older message for the same pin or
+    port, which it also does when the queue isn't full.
+    """
+
+    def __init__(self, board, maxsize=256, policy=BLOCK):
+        super(Writer, self).__init__()
+        if policy not in (BLOCK, DROP_OLDEST, COALESCE):
+            raise ValueError("Unknown writer policy {0}".format(policy))
+        self.daemon = True
+        self.board = board
+        self.maxsize = maxsize
+        self.policy = policy
+        # [key, data, queue time] entries, and the entries by key for COALESCE
+        self._queue = deque()
+        self._queued = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._max_depth = 0
+        self._written = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._last_latency = 0.0
+        self._max_latency = 0.0
+        self._total_latency = 0.0
+        # Set when the serial port failed
+        self.error = None
+
+    def put(self, data, key=None):
+        """
+        Queues ``data`` to be written. Messages with the same ``key``, which
+        is None for messages that can't replace each other, are for the same
+        pin or port.
+        """
+        entry = [key, bytes(data), time.monotonic()]
+        with self._cond:
+            if self._stopped:
+                raise IOError("The writer of {0} is stopped".format(self.board))
+            if self.policy == COALESCE and key is not None:
+                queued = self._queued.get(key)
+                if queued is not None:
+                    queued[1] = entry[1]
+                    self._coalesced += 1
+                    return
+            while len(self._queue) >= self.maxsize:
+                if self.policy == BLOCK:
+                    self._cond.wait()
+                    if self._stopped:
+                        raise IOError("The writer of {0} is stopped".format(self.board))
+                else:
+                    self._drop_oldest()
+            self._queue.append(entry)
+            if self.policy == COALESCE and key is not None:
+                self._queued[key] = entry
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._cond.notify_all()
+
+    def _drop_oldest(self):
+        dropped = self._queue.popleft()
+        if self._queued.get(dropped[0]) is dropped:
+            del self._queued[dropped[0]]
+        self._dropped += 1
+
+    def stats(self):
+        """Returns the current :class:`WriterStats`."""
+        with self._cond:
+            mean = self._total_latency / self._written if self._written else 0.0
+            return WriterStats(len(self._queue), self._max_depth, self._written, self._dropped,
+                               self._coalesced, self._last_latency, self._max_latency, mean)
+
+    def join_queue(self, timeout=None):
+        """
+        Waits until all queued messages are written. Returns whether they
+        were, which is always the case without a ``timeout`` unless the
+        serial port failed (see ``error``).
+        """
+        deadline = timeout is not None and time.monotonic() + timeout
+        with self._cond:
+            while self._queue and self.error is None:
+                remaining = None if deadline is False else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self.error is None
+
+    def stop(self):
+        """Writes the queued messages and ends the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                entries = list(self._queue)
+                self._queue.clear()
+                self._queued.clear()
+                # Room for blocked senders
+                self._cond.notify_all()
+            try:
+                self.board.sp.write(b''.join(entry[1] for entry in entries))
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                # The port was closed or the device is gone
+                with self._cond:
+                    self.error = e
+                    self._stopped = True
+                    self._queue.clear()
+                    self._cond.notify_all()
+                return
+            now = time.monotonic()
+            with self._cond:
+                for entry in entries:
+                    latency = now - entry[2]
+                    self._total_latency += latency
+                    self._max_latency = max(self._max_latency, latency)
+                self._last_latency = latency
+                self._written += len(entries)
+                self._cond.notify_all()
+
+
+# Priority classes of the Scheduler, most urgent first
+SAFETY = 0
+CONTROL = 1
+COSMETIC = 2
+PRIORITIES = (SAFETY, CONTROL, COSMETIC)
+
+SchedulerStats = namedtuple('SchedulerStats', 'depth written dropped replaced utilization '
+                                              'max_latency')
+"""
+Metrics of a :class:`Scheduler`. ``depth``, ``dropped`` and ``max_latency``
+are tuples with a value for every priority class. ``replaced`` counts the
+messages that were replaced by a newer one for the same pin or port before
+they were written. ``utilization`` is the part of the link's capacity used
+during the last second.
+"""
+
+
+class Scheduler(threading.Thread):
+    """
+    A writer thread (see :class:`Writer`) that doesn't write more than the
+    serial link can carry, and writes the most urgent messages first.
+
+    The capacity of the link is ``baudrate / 10`` bytes per second (8 data
+    bits, a start and a stop bit), of which the scheduler uses at most
+    ``utilization``. Because nothing piles up in the buffers of the serial
+    port, a message never waits for more than the queued messages of its own
+    or a higher priority class.
+
+    Messages have the priority set for their pin with
+    :meth:`Board.set_priority`, or ``default_priority``: :data:`SAFETY`,
+    :data:`CONTROL` or :data:`COSMETIC`. A queued message for a pin or port
+    is replaced by a newer one, so only the latest value is written. With
+    more than ``maxsize`` messages queued, the oldest message of the least
+    urgent class is dropped.
+
+    Pin mode changes and sysex messages, like a servo configuration, are
+    never overtaken: when a message is queued, the ones waiting in a less
+    urgent class move up to its class, ahead of it, together with the
+    messages queued before them.
+    """
+
+    # Seconds between writes when the link is busy
+    tick = 0.005
+
+    def __init__(self, board, baudrate, utilization=0.9, default_priority=CONTROL,
+                 maxsize=256):
+        super(Scheduler, self).__init__()
+        if default_priority not in PRIORITIES:
+            raise ValueError("Unknown priority {0}".format(default_priority))
+        self.daemon = True
+        self.board = board
+        self.link_capacity = baudrate / 10.0
+        self.capacity = self.link_capacity * utilization
+        self.default_priority = default_priority
+        self.maxsize = maxsize
+        # [data, queue time] entries by key, for every priority class
+        self._queues = [OrderedDict() for _ in PRIORITIES]
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        # Bytes that may be written now, and when that was computed
+        self._budget = 0.0
+        self._budget_time = time.monotonic()
+        # (time, size) of the writes of the last second
+        self._recent = deque()
+        self._written = 0
+        self._dropped = [0] * len(PRIORITIES)
+        self._replaced = 0
+        self._max_latency = [0.0] * len(PRIORITIES)
+        # Set when the serial port failed
+        self.error = None
+
+    def put(self, data, key=None):
+        """
+        Queues ``data`` with the priority of ``key``, replacing the queued
+        message with the same ``key``. Messages with a key of None never
+        replace each other.
+        """
+        priority = self.board._priorities.get(key, self.default_priority)
+        with self._cond:
+            if self._stopped:
+                raise IOError("The writer of {0} is stopped".format(self.board))
+            queue = self._queues[priority]
+            if key is None:
+                key = object()
+            entry = queue.get(key)
+            if entry is not None:
+                # Keep the place and queue time, the stale value is never written
+                entry[0] = bytes(data)
+                self._replaced += 1
+                return
+            self._promote_dependencies(priority)
+            queue[key] = [bytes(data), time.monotonic()]
+            self._depth += 1
+            if self._depth > self.maxsize:
+                self._drop_least_urgent()
+            self._cond.notify_all()
+
+    def _promote_dependencies(self, priority):
+        """
+        Moves the messages without a key of their own (sysex messages) or
+        with a pin mode key from the less urgent classes to ``priority``,
+        with the data messages queued before them, which a mode change must
+        not overtake. Data messages have integer keys.
+        """
+        queue = self._queues[priority]
+        for lower in self._queues[priority + 1:]:
+            keys = list(lower)
+            dependencies = [i for i, key in enumerate(keys) if not isinstance(key, int)]
+            for key in keys[:dependencies[-1] + 1] if dependencies else ():
+                entry = lower.pop(key)
+                if key not in queue:
+                    queue[key] = entry
+                    continue
+                # Queued in both classes after a priority change, keep the newer
+                if entry[1] > queue[key][1]:
+                    queue[key][0] = entry[0]
+                self._depth -= 1
+                self._replaced += 1
+
+    def _drop_least_urgent(self):
+        for priority in reversed(PRIORITIES):
+            if self._queues[priority]:
+                self._queues[priority].popitem(last=False)
+                self._dropped[priority] += 1
+                self._depth -= 1
+                return
+
+    def _take(self, budget):
+        """
+        Removes and returns the ``(priority, entry)`` pairs of the messages
+        that fit in ``budget`` bytes, most urgent first. The first message is
+        always taken.
+        """
+        taken = []
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue:
+                entry = next(iter(queue.values()))
+                if taken and len(entry[0]) > budget:
+                    return taken
+                queue.popitem(last=False)
+                self._depth -= 1
+                budget -= len(entry[0])
+                taken.append((priority, entry))
+        return taken
+
+    def _refill(self, now):
+        # Allow a burst of at most two ticks
+        self._budget = min(self._budget + (now - self._budget_time) * self.capacity,
+                           2 * self.tick * self.capacity)
+        self._budget_time = now
+
+    def stats(self):
+        """Returns the current :class:`SchedulerStats`."""
+        with self._cond:
+            now = time.monotonic()
+            self._forget_writes(now)
+            utilization = sum(size for _, size in self._recent) / self.link_capacity
+            return SchedulerStats(tuple(len(queue) for queue in self._queues), self._written,
+                                  tuple(self._dropped), self._replaced, utilization,
+                                  tuple(self._max_latency))
+
+    def _forget_writes(self, now):
+        while self._recent and self._recent[0][0] < now - 1:
+            self._recent.popleft()
+
+    def join_queue(self, timeout=None):
+        """
+        Waits until all queued messages are written. Returns whether they
+        were, which is always the case without a ``timeout`` unless the
+        serial port failed (see ``error``).
+        """
+        deadline = timeout is not None and time.monotonic() + timeout
+        with self._cond:
+            while self._depth and self.error is None:
+                remaining = None if deadline is False else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self.error is None
+
+    def stop(self):
+        """Writes the queued messages and ends the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._depth and not self._stopped:
+                    self._cond.wait()
+                if not self._depth:
+                    return
+                now = time.monotonic()
+                self._refill(now)
+                if self._budget < 0:
+                    wait = -self._budget / self.capacity
+                else:
+                    taken = self._take(self._budget)
+                    size = sum(len(entry[0]) for _, entry in taken)
+                    self._budget -= size
+                    wait = None
+            if wait is not None:
+                time.sleep(max(wait, self.tick))
+                continue
+            try:
+                self.board.sp.write(b''.join(entry[0] for _, entry in taken))
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                # The port was closed or the device is gone
+                with self._cond:
+                    self.error = e
+                    self._stopped = True
+                    for queue in self._queues:
+                        queue.clear()
+                    self._depth = 0
+                    self._cond.notify_all()
+                return
+            now = time.monotonic()
+            with self._cond:
+                for priority, entry in taken:
+                    self._max_latency[priority] = max(self._max_latency[priority],
+                                                      now - entry[1])
+                self._written += len(taken)
+                self._recent.append((now, size))
+                self._forget_writes(now)
+                self._cond.notify_all()
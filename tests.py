@@ -1,15 +1,24 @@
 from __future__ import division, unicode_literals
 
+import asyncio
+import os
+import select
+import tempfile
+import threading
+import time
 import unittest
-from itertools import chain
+from concurrent import futures
+from itertools import chain, islice
 
 import serial
 
 import pyfirmata
-from pyfirmata import mockup
+from pyfirmata import aio, cache, capture, mockup, reactor, stream, util, writer
 from pyfirmata.boards import BOARDS
 from pyfirmata.util import (
-    break_to_bytes, from_two_bytes, str_to_two_byte_iter, to_two_bytes, two_byte_iter_to_str
+    Iterator, SampleBuffer, break_to_bytes, capabilities_to_layout, from_two_bytes,
+    parse_analog_mapping, parse_capabilities, str_to_two_byte_iter, to_two_bytes,
+    two_byte_iter_to_str
 )
 
 
@@ -21,6 +30,65 @@ from pyfirmata.util import (
 # system reset          0xFF
 
 
+class FirmwareSerial(mockup.MockupSerial):
+    """A MockupSerial that answers firmware queries instead of echoing them."""
+
+    def write(self, value):
+        if bytearray(value) == bytearray([0xF0, 0x79, 0xF7]):
+            value = [0xF0, 0x79, 2, 5] + list(str_to_two_byte_iter('Test')) + [0xF7]
+        super(FirmwareSerial, self).write(value)
+
+
+class CapabilitySerial(mockup.MockupSerial):
+    """
+    A MockupSerial that answers analog mapping queries, and capability
+    queries after ignoring the first ``ignored`` of them.
+    """
+    ignored = 0
+
+    def __init__(self, port, baudrate, timeout=None):
+        super(CapabilitySerial, self).__init__(port, baudrate, timeout)
+        self.capability_queries = 0
+        self.mapping_queries = 0
+
+    def write(self, value):
+        data = bytearray(value)
+        if bytes([0xF0, pyfirmata.ANALOG_MAPPING_QUERY, 0xF7]) in data:
+            self.mapping_queries += 1
+            self.extend([0xF0, pyfirmata.ANALOG_MAPPING_RESPONSE, 0x7F, 0x7F, 0, 1, 0xF7])
+        if bytes([0xF0, pyfirmata.CAPABILITY_QUERY, 0xF7]) in data:
+            self.capability_queries += 1
+            if self.capability_queries > self.ignored:
+                self.extend([0xF0, pyfirmata.CAPABILITY_RESPONSE]
+                            + [0, 1, 1, 1, 0x7F] * 2 + [0, 1, 1, 1, 2, 10, 0x7F] * 2 + [0xF7])
+
+
+class QuickQueryBoard(pyfirmata.Board):
+    query_timeout = 0.05
+
+
+class PinStateSerial(mockup.MockupSerial):
+    """
+    A MockupSerial that answers pin state queries with the ``(mode, state)``
+    in ``states``, and counts the writes.
+    """
+
+    def __init__(self, states):
+        super(PinStateSerial, self).__init__('', 57600)
+        self.states = states
+        self.writes = 0
+
+    def write(self, value):
+        self.writes += 1
+        data = bytearray(value)
+        for i in range(0, len(data) - 3, 4):
+            pin = data[i + 2]
+            if data[i + 1] == pyfirmata.PIN_STATE_QUERY and pin in self.states:
+                mode, state = self.states[pin]
+                self.extend([0xF0, pyfirmata.PIN_STATE_RESPONSE, pin, mode,
+                             state & 0x7F, state >> 7, 0xF7])
+
+
 class BoardBaseTest(unittest.TestCase):
 
     def setUp(self):
@@ -135,8 +203,9 @@ class TestBoardMessages(BoardBaseTest):
             'digital': (0, 1, 2),
             'analog': (0, 1),
             'pwm': (1, 2),
-            'servo': (0, 1, 2),
-            # 'i2c': (2),  # TODO 2.3 specs
+            # None of the pins has the SERVO mode
+            'servo': (),
+            'i2c': (3, 4),
             'disabled': (0,),
         }
 
@@ -179,6 +248,7 @@ class TestBoardMessages(BoardBaseTest):
         self.board._handle_report_capability_response(*data_arduino)
         for key in test_layout.keys():
             self.assertEqual(self.board._layout[key], test_layout[key])
+        self.assertEqual(self.board._layout['analog_resolution'], 10)
 
     # type                command  channel    first byte            second byte
     # ---------------------------------------------------------------------------
@@ -263,6 +333,163 @@ class TestBoardMessages(BoardBaseTest):
         sysex = (0xF0, 0x79, 1, 2, 3, 0xF7)
         self.assert_serial(*sysex)
 
+    def test_set_sampling_interval(self):
+        self.board.set_sampling_interval(100)
+        self.assert_serial(0xF0, pyfirmata.SAMPLING_INTERVAL, 100, 0, 0xF7)
+        self.assertEqual(self.board.sampling_interval, 100)
+        self.assertRaises(ValueError, self.board.set_sampling_interval, 0)
+        self.assertRaises(ValueError, self.board.set_sampling_interval, 20000)
+
+    def test_auto_sampling_interval(self):
+        # 960 bytes per second, half of it is the target
+        self.board.baudrate = 9600
+        self.board.auto_sampling_interval(0.5, min_interval=10, max_interval=100)
+        self.board.get_pin('a:0:i')
+        self.board.sp.clear()
+        # 960 bytes in a second is twice the target, so the interval doubles
+        self.board._tune_time -= 1
+        self.board._parse(bytearray([pyfirmata.ANALOG_MESSAGE, 1, 0]) * 320)
+        self.assertEqual(self.board.sampling_interval, 38)
+        self.assert_serial(0xF0, pyfirmata.SAMPLING_INTERVAL, 38, 0, 0xF7)
+        # Near the target nothing changes
+        self.board._tune_time -= 1
+        self.board._parse(bytearray([pyfirmata.ANALOG_MESSAGE, 1, 0]) * 120)
+        self.assertEqual(self.board.sampling_interval, 38)
+        # Far below it the interval goes down, but not below the minimum
+        for _ in range(3):
+            self.board._tune_time -= 1
+            self.board._parse(bytearray([pyfirmata.ANALOG_MESSAGE, 1, 0]))
+        self.assertEqual(self.board.sampling_interval, 10)
+        self.board.auto_sampling_interval(None)
+        self.board._tune_time -= 1
+        self.board._parse(bytearray([pyfirmata.ANALOG_MESSAGE, 1, 0]) * 320)
+        self.assertEqual(self.board.sampling_interval, 10)
+
+    def test_i2c_write(self):
+        self.board.i2c_config(100)
+        self.assert_serial(0xF0, pyfirmata.I2C_CONFIG, 100, 0, 0xF7)
+        self.board.i2c_write(0x48, [0x01, 0xFF], register=0x10)
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x48, 0x00,
+                           0x10, 0, 0x01, 0, 0x7F, 1, 0xF7)
+        # 10 bit address
+        self.board.i2c_write(0x2A5, [])
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x25, 0x25, 0xF7)
+
+    def i2c_reply(self, address, register, data):
+        reply = [0xF0, pyfirmata.I2C_REPLY, address, 0, register & 0x7F, register >> 7]
+        for byte in data:
+            reply += [byte & 0x7F, byte >> 7]
+        self.board.sp.write(reply + [0xF7])
+        while self.board.bytes_available():
+            self.board.iterate()
+
+    def test_i2c_read(self):
+        replies = []
+        future = self.board.i2c_read(0x48, 0x00, 2, callback=replies.append)
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x48, 0x08, 0, 0, 2, 0, 0xF7)
+        self.assertFalse(future.done())
+        self.i2c_reply(0x48, 0x00, [0x12, 0xF0])
+        reply = future.result(0)
+        self.assertEqual((reply.address, reply.register, reply.data), (0x48, 0, b'\x12\xf0'))
+        self.assertEqual(replies, [reply])
+        # Reads without a register get a reply without one, though the
+        # firmware sends a dummy register 0, or 0xFF on older versions
+        future = self.board.i2c_read(0x48, count=1)
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x48, 0x08, 1, 0, 0xF7)
+        self.i2c_reply(0x48, 0x00, [5])
+        self.assertEqual(future.result(0).register, None)
+        future = self.board.i2c_read(0x48, count=1)
+        self.i2c_reply(0x48, 0xFF, [6])
+        self.assertEqual((future.result(0).register, future.result(0).data), (None, b'\x06'))
+        self.assertEqual(self.board._i2c_reads, {})
+
+    def test_i2c_reads_in_order(self):
+        first = self.board.i2c_read(0x48, 0x00)
+        second = self.board.i2c_read(0x48, 0x00)
+        self.i2c_reply(0x48, 0x00, [1])
+        self.assertEqual(first.result(0).data, b'\x01')
+        self.assertFalse(second.done())
+        self.i2c_reply(0x48, 0x00, [2])
+        self.assertEqual(second.result(0).data, b'\x02')
+
+    def test_i2c_read_cancelled_and_expired(self):
+        cancelled = self.board.i2c_read(0x48, 0x00, callback=lambda reply: 1 / 0)
+        cancelled.cancel()
+        failing = self.board.i2c_read(0x48, 0x00, callback=lambda reply: 1 / 0)
+        with self.assertLogs('pyfirmata.board', 'ERROR'):
+            self.i2c_reply(0x48, 0x00, [1])
+        self.assertEqual(failing.result(0).data, b'\x01')
+        # Reads without a reply are given up when the next read is made
+        expired = self.board.i2c_read(0x48, 0x01, timeout=0)
+        self.board.i2c_read(0x49)
+        self.assertRaises(futures.TimeoutError, expired.result, 0)
+        self.assertEqual(list(self.board._i2c_reads), [0x49])
+
+    def test_i2c_read_continuously(self):
+        replies = self.board.i2c_read_continuously(0x48, 0x00, 1, capacity=2)
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x48, 0x10, 0, 0, 1, 0, 0xF7)
+        for value in (1, 2, 3):
+            self.i2c_reply(0x48, 0x00, [value])
+        self.assertEqual([reply.data for reply in replies], [b'\x02', b'\x03'])
+        self.board.i2c_stop_reading(0x48)
+        self.assert_serial(0xF0, pyfirmata.I2C_REQUEST, 0x48, 0x18, 0xF7)
+        self.i2c_reply(0x48, 0x00, [4])
+        self.assertEqual(len(replies), 2)
+        # Without a register, with the firmware's dummy register in the replies
+        replies = self.board.i2c_read_continuously(0x49)
+        self.i2c_reply(0x49, 0x00, [5])
+        self.assertEqual([(reply.register, reply.data) for reply in replies], [(None, b'\x05')])
+
+    def test_query_pin_states(self):
+        self.board.sp = PinStateSerial({3: (pyfirmata.PWM, 255), 4: (pyfirmata.OUTPUT, 1)})
+        pin = self.board.get_pin('d:3:p')
+        start = time.monotonic()
+        states = self.board.query_pin_states([pin, 4, 7], timeout=0.1, drive=True)
+        self.assertEqual(states, {pin: (pyfirmata.PWM, 255), 4: (pyfirmata.OUTPUT, 1)})
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(self.board.sp.writes, 2)
+        # The query for the pin that didn't answer is forgotten
+        self.assertEqual(self.board._replies, {})
+        self.assertRaises(ValueError, self.board.query_pin_states, [self.board.analog[0]])
+
+    def test_query_pin_states_without_drive(self):
+        self.board.sp = PinStateSerial({2: (pyfirmata.INPUT, 0)})
+        iterator = Iterator(self.board)
+        iterator.start()
+        try:
+            start = time.monotonic()
+            states = self.board.query_pin_states([2], timeout=1)
+        finally:
+            iterator.stop()
+        self.assertEqual(states, {2: (pyfirmata.INPUT, 0)})
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_reconcile_pin_states(self):
+        led = self.board.get_pin('d:4:o')
+        led.write(1)
+        dimmer = self.board.get_pin('d:3:p')
+        dimmer.write(0.5)
+        modes = [self.board.digital[6].mode, self.board.digital[7].mode]
+        changed = self.board.reconcile_pin_states({
+            3: (pyfirmata.PWM, 128),
+            4: (pyfirmata.OUTPUT, 0),
+            5: (pyfirmata.INPUT, 0),
+            0: (pyfirmata.OUTPUT, 0),
+            6: (pyfirmata.I2C, 0),
+            7: (pyfirmata.ANALOG, 0),
+        })
+        self.assertEqual(changed, [led, self.board.digital[5]])
+        self.assertEqual(dimmer.value, 0.5)
+        self.assertEqual(led.value, 0)
+        self.assertEqual(self.board.digital[5].mode, pyfirmata.INPUT)
+        self.assertEqual(self.board.digital[0].mode, pyfirmata.UNAVAILABLE)
+        # Modes the pin can't be set to are not copied
+        self.assertEqual([self.board.digital[6].mode, self.board.digital[7].mode], modes)
+        # The port is written again, though it was last written like this
+        self.board.sp.clear()
+        led.write(1)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 0x10, 0)
+
     def test_send_sysex_string(self):
         self.board.send_sysex(0x79, bytearray("test", 'ascii'))
         sysex = [0xF0, 0x79]
@@ -298,6 +525,258 @@ class TestBoardMessages(BoardBaseTest):
             self.board.iterate()
         self.assertEqual(self.board.analog[4].read(), 1.0)
 
+    def test_iterate_handles_all_waiting_messages(self):
+        self.board.analog[2].enable_reporting()
+        self.board.analog[3].enable_reporting()
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 2, 127, 7,
+                             pyfirmata.ANALOG_MESSAGE + 3, 0, 0,
+                             pyfirmata.REPORT_VERSION, 2, 5])
+        self.board.iterate()
+        self.assertEqual(len(self.board.sp), 0)
+        self.assertEqual(self.board.analog[2].read(), 1.0)
+        self.assertEqual(self.board.analog[3].read(), 0.0)
+        self.assertEqual(self.board.firmata_version, (2, 5))
+
+    def test_iterate_resumes_partial_message(self):
+        self.board.analog[4].enable_reporting()
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 127])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), None)
+        self.board.sp.write([7, pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2, 1])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), 1.0)
+        self.assertEqual(self.board.firmware, None)
+        self.board.sp.write(list(str_to_two_byte_iter('abc')) + [pyfirmata.END_SYSEX])
+        self.board.iterate()
+        self.assertEqual(self.board.firmware, 'abc')
+
+    def test_add_cmd_handler(self):
+        received = []
+
+        def handle_string_data(*data):
+            received.append(two_byte_iter_to_str(data))
+
+        def handle_report_version(major, minor):
+            received.append((major, minor))
+
+        self.board.add_cmd_handler(pyfirmata.STRING_DATA, handle_string_data)
+        self.board.add_cmd_handler(pyfirmata.REPORT_VERSION, handle_report_version)
+        self.assertEqual(self.board._command_handlers[pyfirmata.REPORT_VERSION],
+                         (handle_report_version, 2))
+        # Channel commands are entered for all 16 channels
+        self.assertEqual(self.board._command_handlers[pyfirmata.ANALOG_MESSAGE + 15][1], 2)
+        self.board.sp.write([pyfirmata.START_SYSEX, pyfirmata.STRING_DATA]
+                            + list(str_to_two_byte_iter('hi')) + [pyfirmata.END_SYSEX])
+        self.board.sp.write([pyfirmata.REPORT_VERSION, 2, 6])
+        self.board.iterate()
+        self.assertEqual(received, ['hi', (2, 6)])
+
+    def test_resync_on_interrupted_message(self):
+        self.board.analog[4].enable_reporting()
+        self.board.sp.clear()
+        # A truncated analog message and an unterminated sysex message are
+        # thrown away when the next command starts
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 127,
+                             pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2,
+                             pyfirmata.ANALOG_MESSAGE + 4, 127, 7])
+        self.board.iterate()
+        self.assertEqual(self.board.analog[4].read(), 1.0)
+        self.assertEqual(self.board.firmware_version, None)
+        self.assertEqual(self.board.discarded_bytes, 5)
+
+    def test_sysex_too_long(self):
+        self.board.max_sysex_size = 8
+        self.board.sp.write([pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE, 2, 1]
+                            + list(str_to_two_byte_iter('abc')))
+        self.board.iterate()
+        self.assertEqual(self.board.discarded_bytes, 10)
+        self.board.sp.write([pyfirmata.END_SYSEX, pyfirmata.REPORT_VERSION, 2, 1])
+        self.board.iterate()
+        self.assertEqual(self.board.firmware, None)
+        self.assertEqual(self.board.firmata_version, (2, 1))
+
+    def test_pin_subscribe(self):
+        changes = []
+        pin = self.board.get_pin('a:4:i')
+        pin.subscribe(changes.append)
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 0, 0,
+                             pyfirmata.ANALOG_MESSAGE + 4, 0, 0,
+                             pyfirmata.ANALOG_MESSAGE + 4, 127, 7])
+        self.board.iterate()
+        # One batch for the whole read, without the repeated value
+        self.assertEqual(len(changes), 1)
+        self.assertEqual([(c.pin, c.old_value, c.new_value) for c in changes[0]],
+                         [(pin, None, 0.0), (pin, 0.0, 1.0)])
+        self.assertEqual(changes[0][0].timestamp, changes[0][1].timestamp)
+        pin.unsubscribe(changes.append)
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 0, 0])
+        self.board.iterate()
+        self.assertEqual(len(changes), 1)
+
+    def test_failing_subscriber(self):
+        changes = []
+        pin = self.board.get_pin('a:4:i')
+        pin.subscribe(lambda batch: 1 / 0)
+        pin.subscribe(changes.append)
+        self.board.sp.clear()
+        self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, 127, 7])
+        with self.assertLogs('pyfirmata.board', 'ERROR'):
+            self.board.iterate()
+        self.assertEqual(len(changes), 1)
+
+    def test_port_subscribe_with_executor(self):
+        changes = []
+        port = self.board.digital_ports[1]
+        self.board.get_pin('d:8:i')
+        self.board.get_pin('d:9:i')
+        self.board.sp.clear()
+        with futures.ThreadPoolExecutor(1) as executor:
+            port.subscribe(changes.extend, executor)
+            self.board.sp.write([pyfirmata.DIGITAL_MESSAGE + 1, 0x03, 0,
+                                 pyfirmata.DIGITAL_MESSAGE + 1, 0x02, 0])
+            self.board.iterate()
+        self.assertEqual([(c.pin.pin_number, c.new_value) for c in changes],
+                         [(8, True), (9, True), (8, False)])
+
+    def test_pin_buffer(self):
+        pin = self.board.get_pin('a:4:i')
+        buf = pin.enable_buffer(4)
+        self.board.sp.clear()
+        for value in range(6):
+            self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 4, value, 0])
+        self.board.iterate()
+        values, timestamps = buf.last()
+        self.assertEqual(list(values), [2, 3, 4, 5])
+        self.assertEqual(len(set(timestamps)), 1)
+        self.assertEqual(buf.count, 6)
+
+    def test_stream(self):
+        self.board.get_pin('d:9:i')
+        with self.board.stream(['a:1', self.board.digital[9]], drive=True) as stream:
+            self.board.sp.clear()
+            self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 1, 127, 7,
+                                 pyfirmata.DIGITAL_MESSAGE + 1, 0x02, 0])
+            batch = next(stream)
+            self.assertEqual([(s.pin.pin_number, s.value) for s in batch], [(1, 1.0), (9, True)])
+            self.board.sp.write([pyfirmata.ANALOG_MESSAGE + 1, 0, 0,
+                                 pyfirmata.ANALOG_MESSAGE + 1, 1, 0])
+            values = [s.value for s in islice(stream.samples(), 2)]
+            self.assertEqual(values, [0.0, 0.001])
+        self.assertEqual(self.board._streams, [])
+        self.assertEqual(self.board.analog[1]._streams, ())
+
+    def test_stream_full_queue_and_close(self):
+        stream = self.board.stream(['a:1'], maxsize=1)
+        message = bytearray([pyfirmata.ANALOG_MESSAGE + 1, 127, 7])
+        self.board._parse(message)
+        parser = threading.Thread(target=self.board._parse, args=(message,))
+        parser.start()
+        parser.join(0.1)
+        # Blocked on the full queue until the stream is closed
+        self.assertTrue(parser.is_alive())
+        stream.close()
+        parser.join(1)
+        self.assertFalse(parser.is_alive())
+        self.assertEqual(len(next(stream)), 1)
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_stream_overflow(self):
+        stream = self.board.stream(['a:1'], maxsize=1)
+        stream.overflow_timeout = 0.01
+        self.board.analog[1].set_value_mode(pyfirmata.RAW)
+        for value in (1, 2, 3):
+            self.board._parse(bytearray([pyfirmata.ANALOG_MESSAGE + 1, value, 0]))
+        self.assertEqual(stream.dropped, 2)
+        self.assertEqual(next(stream)[0].value, 3)
+        stream.close()
+
+    def test_batch(self):
+        writes = []
+        write = self.board.sp.write
+        self.board.sp.write = lambda data: writes.append(bytes(data)) or write(data)
+        with self.board.batch():
+            self.board.digital[2].write(1)
+            self.board.digital[3].write(1)
+            self.board.digital[9].write(1)
+            self.board.digital[2].write(0)
+            self.assertEqual(writes, [])
+        # The replaced message keeps its place
+        self.assertEqual(writes, [bytes([pyfirmata.DIGITAL_MESSAGE, 8, 0,
+                                         pyfirmata.DIGITAL_MESSAGE + 1, 2, 0])])
+        self.board.digital[3].write(0)
+        self.assertEqual(len(writes), 2)
+        # A port message doesn't move behind a later mode change of another port
+        del writes[:]
+        with self.board.batch():
+            self.board.digital[4].write(1)
+            self.board.digital[13].mode = pyfirmata.INPUT
+            self.board.digital[4].write(0)
+        self.assertEqual(writes[0][:6], bytes([pyfirmata.DIGITAL_MESSAGE, 0, 0,
+                                               pyfirmata.SET_PIN_MODE, 13, pyfirmata.INPUT]))
+        # But it does behind one for its own pins, which it may carry a value for
+        self.board.digital[11].mode = pyfirmata.PWM
+        del writes[:]
+        with self.board.batch():
+            self.board.digital[10].write(1)
+            self.board.digital[11].mode = pyfirmata.OUTPUT
+            self.board.digital[11].write(1)
+        self.assertEqual(writes, [bytes([pyfirmata.SET_PIN_MODE, 11, pyfirmata.OUTPUT,
+                                         pyfirmata.DIGITAL_MESSAGE + 1, 14, 0])])
+
+    def test_auto_flush(self):
+        self.board.auto_flush(60)
+        self.board.digital[2].write(1)
+        self.board.send_sysex(pyfirmata.QUERY_FIRMWARE, [])
+        self.assertEqual(len(self.board.sp), 0)
+        self.board.auto_flush(None)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 4, 0,
+                           pyfirmata.START_SYSEX, pyfirmata.QUERY_FIRMWARE, pyfirmata.END_SYSEX)
+        self.board.digital[2].write(0)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 0, 0)
+
+    def test_port_write_skips_unchanged_mask(self):
+        self.board.digital[2].write(1)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 4, 0)
+        # Pin 3 was low already, so the port doesn't change
+        self.board.digital[3].write(0)
+        self.assert_serial()
+        self.board.digital[3].write(1)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 12, 0)
+        port = self.board.digital_ports[0]
+        # Writing the port explicitly always sends
+        port.write()
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 12, 0)
+        self.board.digital[3].mode = pyfirmata.INPUT
+        self.assertEqual(port._output_pins & 8, 0)
+        self.assertEqual(port._input_pins & 8, 8)
+        # After a mode change the port is written again
+        self.board.digital[3].mode = pyfirmata.OUTPUT
+        self.board.sp.clear()
+        self.board.digital[4].write(0)
+        self.assert_serial(pyfirmata.DIGITAL_MESSAGE, 12, 0)
+
+    def test_analog_value_modes(self):
+        pin = self.board.get_pin('a:1:i')
+        self.board._handle_analog_message(1, 0, 4)
+        self.assertEqual(pin.read(), 0.5005)
+        pin.set_value_mode(pyfirmata.RAW)
+        self.board._handle_analog_message(1, 1, 4)
+        self.assertEqual(pin.read(), 513)
+        pin.set_value_mode(pyfirmata.CALIBRATED, [raw * 2 for raw in range(1024)])
+        self.board._handle_analog_message(1, 2, 4)
+        self.assertEqual(pin.read(), 1028)
+        self.assertRaises(ValueError, pin.set_value_mode, pyfirmata.CALIBRATED)
+
+    def test_analog_resolution(self):
+        layout = dict(BOARDS['arduino'], analog_resolution=12)
+        self.board.setup_layout(layout)
+        pin = self.board.get_pin('a:0:i')
+        self.board._handle_analog_message(0, 127, 31)
+        self.assertEqual(pin.read(), 1.0)
+
     # Servo config
     # --------------------
     # 0  START_SYSEX (0xF0)
@@ -384,6 +863,106 @@ class TestBoardLayout(BoardBaseTest):
         self.assertEqual(pin.reporting, True)
         self.assertEqual(pin.value, None)
 
+    def test_capabilities_layout(self):
+        self.board._handle_analog_mapping_response(0x7F, 0x7F, 0x7F, 0, 1)
+        self.board._handle_report_capability_response(
+            0x7F,
+            0, 1, 1, 1, 3, 10, 0x7F,
+            0, 1, 1, 1, 4, 14, 0x7F,
+            0, 1, 1, 1, 2, 10, 0x7F,
+            0, 1, 1, 1, 2, 10, 0x7F)
+        pyfirmata.pyfirmata.serial.Serial = mockup.MockupSerial
+        board = pyfirmata.Board('', self.board._layout)
+        self.assertEqual([pin.pin_number for pin in board.analog], [0, 1])
+        self.assertEqual(board.digital[0].mode, pyfirmata.UNAVAILABLE)
+        self.assertRaises(IOError, board.get_pin, 'd:2:p')
+        self.assertFalse(board.taken['digital'][2])
+        servo = board.get_pin('d:2:s')
+        self.assertRaises(IOError, setattr, servo, 'mode', pyfirmata.PWM)
+        # PWM values are scaled to the resolution of the pin
+        pwm = board.get_pin('d:1:p')
+        board.sp.clear()
+        pwm.write(1)
+        self.assertEqual(list(board.sp), [pyfirmata.ANALOG_MESSAGE + 1, 1023 % 128, 1023 >> 7])
+
+    def test_pins_created_lazily(self):
+        mega = mockup.MockupBoard('', BOARDS['arduino_mega'])
+        self.assertEqual(mega.digital_ports[3].pins.created(), [])
+        self.assertEqual(mega.analog.created(), [])
+        pin = mega.get_pin('d:30:o')
+        self.assertIs(mega.digital_ports[3].pins.created()[0], pin)
+        self.assertIs(mega.digital[30], pin)
+        self.assertEqual(mega.digital[1].mode, pyfirmata.UNAVAILABLE)
+        self.assertTrue(mega.digital[2].PWM_CAPABLE)
+        self.assertFalse(hasattr(pin, '__dict__'))
+        self.assertFalse(hasattr(pin.port, '__dict__'))
+
+    def test_mockup_board_and_port(self):
+        board = mockup.MockupBoard('test', BOARDS['arduino'], {'d': {11: True}})
+        board.update_values_dict()
+        port = mockup.MockupPort(board, 1)
+        self.assertEqual(len(port.pins), 8)
+        self.assertEqual(port.pins.created(), [])
+        pin = port.pins[2]
+        self.assertIsInstance(pin, mockup.MockupPin)
+        self.assertEqual(pin.pin_number, 10)
+        pin.write(1)
+        self.assertEqual(pin.read(), 1)
+        port.values_dict = board.values_dict
+        port.update_values_dict()
+        self.assertEqual(port.pins[3].read(), True)
+
+    def test_lazy_pins_like_a_list(self):
+        pins = list(self.board.analog)
+        self.assertEqual(self.board.analog, pins)
+        self.assertNotEqual(self.board.analog, pins[:-1])
+        self.assertEqual(self.board.analog.index(pins[2]), 2)
+        self.assertIn(pins[3], self.board.analog)
+        self.assertEqual(list(reversed(self.board.analog)), pins[::-1])
+
+    def test_setup_waits_for_firmware(self):
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 5
+        try:
+            start = time.time()
+            board = pyfirmata.Board('', BOARDS['arduino'])
+            self.assertLess(time.time() - start, 1)
+        finally:
+            pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+        self.assertEqual(board.firmware, 'Test')
+        self.assertEqual(board.firmware_version, (2, 5))
+
+    def test_setup_fails_without_firmware(self):
+        # The mockup only echoes the queries, which are not an answer
+        pyfirmata.pyfirmata.serial.Serial = mockup.MockupSerial
+        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0.05
+        try:
+            self.assertRaises(IOError, pyfirmata.Board, '', BOARDS['arduino'])
+        finally:
+            pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+
+    def auto_setup_board(self, ignored):
+        pyfirmata.pyfirmata.serial.Serial = CapabilitySerial
+        CapabilitySerial.ignored = ignored
+        return QuickQueryBoard('')
+
+    def test_auto_setup(self):
+        start = time.monotonic()
+        board = self.auto_setup_board(0)
+        # Set up as soon as the response is there
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.assertEqual([pin.pin_number for pin in board.analog], [0, 1])
+        self.assertEqual(board.sp.capability_queries, 1)
+        self.assertEqual(board._replies, {})
+
+    def test_auto_setup_retries(self):
+        board = self.auto_setup_board(2)
+        self.assertEqual(board.sp.capability_queries, 3)
+        # The analog mapping is asked for along with every capability query
+        self.assertEqual(board.sp.mapping_queries, 3)
+        self.assertEqual([pin.pin_number for pin in board.analog], [0, 1])
+        self.assertRaises(IOError, self.auto_setup_board, 3)
+
     def tearDown(self):
         self.board.exit()
         pyfirmata.serial.Serial = serial.Serial
@@ -458,6 +1037,23 @@ class RegressionTests(BoardBaseTest):
         self.assertEqual(self.board.digital[12].value, False)
         self.assertEqual(self.board.digital[13].value, None)
 
+    def test_port_update_changed_mask(self):
+        port = self.board.digital_ports[1]
+        self.board.get_pin('d:8:i')
+        self.board.get_pin('d:9:i')
+        self.board._handle_digital_message(1, 0x01, 0)
+        self.assertEqual(port.mask, 0x01)
+        self.assertEqual(port.changed_mask, 0x03)
+        self.board._handle_digital_message(1, 0x03, 0)
+        self.assertEqual(port.changed_mask, 0x02)
+        self.assertEqual((self.board.digital[8].value, self.board.digital[9].value),
+                         (True, True))
+        # A pin that becomes an input gets its value from the next message
+        self.board.get_pin('d:10:i')
+        self.board._handle_digital_message(1, 0x03, 0)
+        self.assertEqual(port.changed_mask, 0x04)
+        self.assertEqual(self.board.digital[10].value, False)
+
     def test_proper_exit_conditions(self):
         """
         Test that the exit method works properly if we didn't make it all
@@ -470,6 +1066,429 @@ class RegressionTests(BoardBaseTest):
             self.fail("exit() raised an AttributeError unexpectedly!")
 
 
+class LayoutCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.path)
+        self.cache = cache.LayoutCache(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get('somewhere', 'Test', (2, 5)))
+        self.assertTrue(self.cache.put('somewhere', 'Test', (2, 5), BOARDS['arduino']))
+        self.assertFalse(self.cache.put('somewhere', 'Test', (2, 5), BOARDS['arduino']))
+        layout = cache.LayoutCache(self.path).get('somewhere', 'Test', (2, 5))
+        self.assertEqual(layout['pwm'], list(BOARDS['arduino']['pwm']))
+        # Another firmware doesn't get the layout, and replaces it
+        self.assertIsNone(self.cache.get('somewhere', 'Other', (2, 5)))
+        self.assertIsNone(self.cache.get('somewhere', 'Test', (2, 4)))
+        self.assertTrue(self.cache.put('somewhere', 'Test', (2, 4), BOARDS['arduino']))
+        self.assertIsNone(self.cache.get('somewhere', 'Test', (2, 5)))
+        self.cache.remove('somewhere')
+        self.assertIsNone(self.cache.get('somewhere', 'Test', (2, 4)))
+        # Written through a temporary file that replaces the cache
+        directory, name = os.path.split(self.path)
+        self.assertFalse([f for f in os.listdir(directory) if f.startswith(name + '.')])
+
+    def test_board_uses_cached_layout(self):
+        self.cache.put('somewhere', 'Test', (2, 5), BOARDS['arduino_nano'])
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 5
+        try:
+            board = pyfirmata.Board('', layout_cache=self.cache)
+        finally:
+            pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+            pyfirmata.pyfirmata.serial.Serial = serial.Serial
+        self.assertEqual(len(board.analog), len(BOARDS['arduino_nano']['analog']))
+        self.assertTrue(board._layout_from_cache)
+
+        # A layout different from the cached one replaces it
+        response = [0, 1, 1, 1, 127] * 4 + [0, 1, 1, 1, 2, 10, 127] * 2
+        with self.assertWarns(RuntimeWarning):
+            board._handle_report_capability_response(*response)
+        self.assertEqual(self.cache.get('somewhere', 'Test', (2, 5))['analog'], [0, 1])
+        board.exit()
+
+
+class CaptureTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record(self):
+        board = mockup.MockupBoard('test', BOARDS['arduino'])
+        board.start_recording(self.path)
+        board.analog[2].enable_reporting()
+        board.sp.serial.clear()
+        board.sp.serial.write([pyfirmata.ANALOG_MESSAGE + 2, 127])
+        board.iterate()
+        board.sp.serial.write([7, pyfirmata.REPORT_VERSION, 2, 5])
+        board.iterate()
+        board.stop_recording()
+        self.assertIsInstance(board.sp, mockup.MockupSerial)
+
+    def test_record(self):
+        self.record()
+        with open(self.path, 'rb') as f:
+            records = [(d, bytes(data)) for _, d, data in capture.read_capture(f.read())]
+        self.assertEqual(records, [
+            (capture.OUTGOING, bytes([pyfirmata.REPORT_ANALOG + 2, 1])),
+            (capture.INCOMING, bytes([pyfirmata.ANALOG_MESSAGE + 2, 127])),
+            (capture.INCOMING, bytes([7, pyfirmata.REPORT_VERSION, 2, 5])),
+        ])
+
+    def test_replay(self):
+        self.record()
+        board = mockup.MockupBoard('test', BOARDS['arduino'])
+        board.analog[2].reporting = True
+        board.sp = mockup.ReplaySerial(self.path)
+        self.assertEqual(board.bytes_available(), 2)
+        while not board.sp.finished:
+            board.iterate()
+        self.assertEqual(board.analog[2].read(), 1.0)
+        self.assertEqual(board.firmata_version, (2, 5))
+        board.exit()
+
+    def test_replay_speed(self):
+        self.record()
+        replay = mockup.ReplaySerial(self.path, speed=1000000)
+        replay.read(2)
+        self.assertEqual(replay.read(4), bytearray([7, pyfirmata.REPORT_VERSION, 2, 5]))
+        self.assertTrue(replay.finished)
+        replay.close()
+
+
+class IteratorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.board = mockup.MockupBoard('test', BOARDS['arduino'])
+
+    def test_stop(self):
+        it = Iterator(self.board)
+        it.start()
+        it.stop()
+        it.join(1)
+        self.assertFalse(it.is_alive())
+
+    @unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pty')
+    def test_use_select(self):
+        master, slave = os.openpty()
+        # serial.Serial may be replaced by MockupSerial in other tests
+        self.board.sp = serial.serialposix.Serial(os.ttyname(slave), timeout=0)
+        self.board.analog[2].reporting = True
+        it = Iterator(self.board, use_select=True)
+        it.start()
+        try:
+            os.write(master, bytearray([pyfirmata.ANALOG_MESSAGE + 2, 127, 7]))
+            for _ in range(100):
+                if self.board.analog[2].value is not None:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.board.analog[2].value, 1.0)
+        finally:
+            it.stop()
+            it.join(1)
+            self.board.sp.close()
+            os.close(master)
+            os.close(slave)
+        self.assertFalse(it.is_alive())
+        # The pipe is closed, stopping again doesn't write to it
+        self.assertIsNone(it._wakeup)
+        it.stop()
+
+    def test_no_pipe_before_start(self):
+        it = Iterator(self.board, use_select=True)
+        self.assertIsNone(it._wakeup)
+        it.stop()
+
+
+class WriterTests(BoardBaseTest):
+
+    def test_writer_thread(self):
+        writer = self.board.start_writer()
+        pin = self.board.get_pin('d:9:p')
+        pin.write(1)
+        self.board.send_sysex(pyfirmata.QUERY_FIRMWARE, [])
+        self.assertTrue(writer.join_queue(1))
+        self.assertEqual(list(self.board.sp), [pyfirmata.SET_PIN_MODE, 9, pyfirmata.PWM,
+                                               pyfirmata.ANALOG_MESSAGE + 9, 127, 1,
+                                               0xF0, pyfirmata.QUERY_FIRMWARE, 0xF7])
+        stats = writer.stats()
+        self.assertEqual((stats.depth, stats.written, stats.dropped), (0, 3, 0))
+        self.assertGreaterEqual(stats.max_latency, stats.mean_latency)
+        self.board.stop_writer()
+        self.assertFalse(writer.is_alive())
+        self.assertRaises(IOError, writer.put, b'\xff')
+
+    def test_join_queue_after_port_failure(self):
+        def fail(data):
+            raise serial.SerialException("Device disconnected")
+        self.board.sp.write = fail
+        for start in (self.board.start_writer, self.board.start_scheduler):
+            queue = start()
+            self.board.send_sysex(pyfirmata.QUERY_FIRMWARE, [])
+            self.assertFalse(queue.join_queue(1))
+            self.assertFalse(queue.join_queue())
+            self.assertIsInstance(queue.error, serial.SerialException)
+            self.board.stop_writer()
+
+    def test_full_queue_policies(self):
+        # Not started, so nothing is taken from the queue
+        messages = [bytearray([pyfirmata.ANALOG_MESSAGE + pin, value, 0])
+                    for pin, value in ((3, 1), (5, 1), (3, 2), (6, 1))]
+        drop = writer.Writer(self.board, maxsize=2, policy=writer.DROP_OLDEST)
+        for msg in messages:
+            drop.put(msg, msg[0])
+        self.assertEqual([e[1] for e in drop._queue], [messages[2], messages[3]])
+        self.assertEqual(drop.stats().dropped, 2)
+
+        coalesce = writer.Writer(self.board, maxsize=2, policy=writer.COALESCE)
+        for msg in messages:
+            coalesce.put(msg, msg[0])
+        # The value for pin 3 was replaced in place, then dropped as the oldest
+        self.assertEqual([e[1] for e in coalesce._queue], [messages[1], messages[3]])
+        self.assertEqual((coalesce.stats().coalesced, coalesce.stats().dropped), (1, 1))
+        self.assertRaises(ValueError, writer.Writer, self.board, policy='wait')
+
+    def test_scheduler_priorities(self):
+        led = self.board.get_pin('d:3:p')
+        self.board.set_priority(led, writer.COSMETIC)
+        self.board.set_priority(self.board.digital_ports[1], writer.SAFETY)
+        scheduler = writer.Scheduler(self.board, 57600, maxsize=3)
+        for value in range(5):
+            led_msg = bytearray([pyfirmata.ANALOG_MESSAGE + 3, value, 0])
+            scheduler.put(led_msg, self.board._message_key(led_msg))
+        motor_msg = bytearray([pyfirmata.ANALOG_MESSAGE + 5, 1, 0])
+        scheduler.put(motor_msg, self.board._message_key(motor_msg))
+        stop_msg = bytearray([pyfirmata.DIGITAL_MESSAGE + 1, 0, 0])
+        scheduler.put(stop_msg, self.board._message_key(stop_msg))
+        self.assertEqual(scheduler.stats().depth, (1, 1, 1))
+        self.assertEqual(scheduler.stats().replaced, 4)
+        # Most urgent first, only the latest value, as much as fits
+        taken = scheduler._take(6)
+        self.assertEqual([entry[0] for _, entry in taken], [stop_msg, motor_msg])
+        # A full queue drops the least urgent message
+        for _ in range(3):
+            scheduler.put(motor_msg, None)
+        self.assertEqual(scheduler.stats().dropped, (0, 0, 1))
+
+    def test_scheduler_keeps_dependencies(self):
+        def take_all(messages):
+            scheduler = writer.Scheduler(self.board, 57600, default_priority=writer.COSMETIC)
+            for msg in messages:
+                scheduler.put(msg, self.board._message_key(msg))
+            depth = scheduler.stats().depth
+            return depth, [messages.index(entry[0]) for _, entry in scheduler._take(100)]
+
+        # A mode change doesn't overtake the port value queued before it,
+        # which would turn on the pull-up of the new input pin
+        self.board.set_priority(self.board.digital_ports[0], writer.SAFETY)
+        self.assertEqual(take_all([
+            bytearray([pyfirmata.DIGITAL_MESSAGE + 1, 0x20, 0]),
+            bytearray([pyfirmata.SET_PIN_MODE, 13, pyfirmata.INPUT]),
+            bytearray([pyfirmata.DIGITAL_MESSAGE, 4, 0]),
+        ]), ((3, 0, 0), [0, 1, 2]))
+
+        self.board.set_priority(self.board.digital_ports[1], writer.SAFETY)
+        # The mode change and servo configuration go first with the value
+        # queued before them, the cosmetic value that doesn't depend on
+        # anything after the port
+        self.assertEqual(take_all([
+            bytearray([pyfirmata.ANALOG_MESSAGE + 5, 1, 0]),
+            bytearray([pyfirmata.SET_PIN_MODE, 9, pyfirmata.OUTPUT]),
+            bytearray([0xF0, pyfirmata.SERVO_CONFIG, 10, 0, 0, 0, 0, 0xF7]),
+            bytearray([pyfirmata.ANALOG_MESSAGE + 3, 1, 0]),
+            bytearray([pyfirmata.DIGITAL_MESSAGE + 1, 2, 0]),
+        ]), ((4, 0, 1), [0, 1, 2, 4, 3]))
+
+    def test_scheduler_link_capacity(self):
+        # 960 bytes per second, of which 864 are used
+        self.board.baudrate = 9600
+        scheduler = self.board.start_scheduler()
+        start = time.time()
+        for pin in range(2, 14):
+            self.board.digital[pin].mode = pyfirmata.INPUT
+        self.assertTrue(scheduler.join_queue(2))
+        # 40 bytes, minus a burst of about 9 bytes
+        self.assertGreater(time.time() - start, 0.02)
+        self.assertEqual(len(self.board.sp), 12 * 3 + 2 * 2)
+        stats = scheduler.stats()
+        self.assertEqual(stats.written + stats.replaced, 24)
+        self.assertTrue(0 < stats.utilization <= 1)
+        self.board.stop_writer()
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pty')
+class BoardReactorTests(unittest.TestCase):
+    """Runs boards on ptys in one BoardReactor."""
+
+    def setUp(self):
+        self.ptys = [os.openpty() for _ in range(3)]
+        # serial.Serial may be replaced by MockupSerial in other tests
+        pyfirmata.pyfirmata.serial.Serial = serial.serialposix.Serial
+        pyfirmata.pyfirmata.BOARD_SETUP_WAIT_TIME = 0
+        self.boards = [pyfirmata.Board(os.ttyname(slave), BOARDS['arduino'])
+                       for master, slave in self.ptys]
+        pyfirmata.pyfirmata.serial.Serial = serial.Serial
+        self.reactor = reactor.BoardReactor(self.boards, flush_interval=0.01)
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.reactor.join()
+        for board in self.boards:
+            board.exit()
+        for master, slave in self.ptys:
+            os.close(slave)
+            if master is not None:
+                os.close(master)
+
+    def read_master(self, master):
+        if not select.select([master], [], [], 2)[0]:
+            return b''
+        return os.read(master, 64)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_read_boards(self):
+        pins = [board.get_pin('a:0:i') for board in self.boards]
+        for i, (master, slave) in enumerate(self.ptys):
+            pins[i].set_value_mode(pyfirmata.RAW)
+            os.write(master, bytearray([pyfirmata.ANALOG_MESSAGE, i, 0]))
+        self.wait_for(lambda: [pin.value for pin in pins] == [0, 1, 2])
+        health = self.reactor.health(self.boards[1])
+        self.assertTrue(health.connected)
+        self.assertEqual(health.bytes_received, 3)
+        self.assertIsNone(health.error)
+
+    def test_flush_and_remove(self):
+        master = self.ptys[0][0]
+        pin = self.boards[0].get_pin('d:13:o')
+        # Collected in a batch written by the reactor
+        pin.write(0)
+        pin.write(1)
+        self.assertEqual(self.read_master(master), bytes([pyfirmata.DIGITAL_MESSAGE + 1, 32, 0]))
+        self.reactor.remove(self.boards[0])
+        self.wait_for(lambda: self.boards[0] not in self.reactor.boards)
+        pin.write(0)
+        self.assertEqual(self.read_master(master), bytes([pyfirmata.DIGITAL_MESSAGE + 1, 0, 0]))
+
+    def test_drop_failing_board(self):
+        os.close(self.ptys[2][0])
+        self.ptys[2] = (None, self.ptys[2][1])
+        self.wait_for(lambda: self.reactor.health(self.boards[2]).error is not None)
+        self.assertFalse(self.reactor.health(self.boards[2]).connected)
+        self.assertEqual(self.reactor.boards, self.boards[:2])
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pty')
+class AsyncBoardTests(unittest.TestCase):
+    """
+    Runs an AsyncBoard on a pty. The master side acts as the firmware and
+    answers firmware and pin state queries.
+    """
+
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        self.received = bytearray()
+        self.ignored_pin_queries = 0
+
+    def tearDown(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def firmware_reader(self):
+        data = os.read(self.master, 1024)
+        self.received += data
+        if self.received.endswith(bytes([0xF0, pyfirmata.QUERY_FIRMWARE, 0xF7])):
+            os.write(self.master, bytearray([0xF0, pyfirmata.REPORT_FIRMWARE, 2, 5])
+                     + str_to_two_byte_iter('Test') + bytearray([0xF7]))
+        for query in data.split(bytes([0xF0, pyfirmata.PIN_STATE_QUERY]))[1:]:
+            if self.ignored_pin_queries:
+                self.ignored_pin_queries -= 1
+                continue
+            os.write(self.master, bytearray([0xF0, pyfirmata.PIN_STATE_RESPONSE, query[0],
+                                             pyfirmata.PWM, 0x7F, 0x01, 0xF7]))
+
+    def run_board(self, coro_func):
+        async def run():
+            loop = asyncio.get_running_loop()
+            loop.add_reader(self.master, self.firmware_reader)
+            # serial.Serial may be replaced by MockupSerial in other tests
+            real_serial = aio.serial.Serial
+            aio.serial.Serial = serial.serialposix.Serial
+            try:
+                async with aio.AsyncBoard(os.ttyname(self.slave), BOARDS['arduino']) as board:
+                    await coro_func(board)
+            finally:
+                aio.serial.Serial = real_serial
+                loop.remove_reader(self.master)
+        asyncio.run(run())
+
+    def test_open_and_queries(self):
+        async def check(board):
+            self.assertEqual(board.firmware, 'Test')
+            self.assertEqual(board.firmware_version, (2, 5))
+            self.assertEqual(await board.query_firmware(), ('Test', (2, 5)))
+            self.assertEqual(await board.query_pin_state(3), (pyfirmata.PWM, 255))
+        self.run_board(check)
+
+    def test_query_retries(self):
+        async def check(board):
+            self.ignored_pin_queries = 2
+            with self.assertRaises(asyncio.TimeoutError):
+                await board.query_pin_state(3, timeout=0.05)
+            self.assertEqual(board._replies, {})
+            self.assertEqual(await board.query_pin_state(3, timeout=0.05, retries=1),
+                             (pyfirmata.PWM, 255))
+            self.assertEqual(self.ignored_pin_queries, 0)
+            self.assertEqual(board._replies, {})
+        self.run_board(check)
+
+    def test_query_pin_states(self):
+        async def check(board):
+            pin = board.get_pin('d:3:p')
+            self.ignored_pin_queries = 1
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            states = await board.query_pin_states([pin, 4], timeout=0.2)
+            # Pipelined, so pin 4 answered while pin 3 was waited for
+            self.assertEqual(states, {4: (pyfirmata.PWM, 255)})
+            self.assertLess(loop.time() - start, 0.4)
+            states = await board.query_pin_states([pin, 4], timeout=0.2)
+            self.assertEqual(states, {pin: (pyfirmata.PWM, 255), 4: (pyfirmata.PWM, 255)})
+            self.assertEqual(board._replies, {})
+        self.run_board(check)
+
+    def test_wait_for_change_and_samples(self):
+        async def check(board):
+            pin = board.get_pin('a:1:i')
+            samples = board.samples(pin)
+            waiter = asyncio.ensure_future(board.wait_for_change(pin, timeout=1))
+            for value in (0, 0, 1023):
+                os.write(self.master, bytearray([pyfirmata.ANALOG_MESSAGE + 1,
+                                                 value % 128, value >> 7]))
+            self.assertEqual(await waiter, 0.0)
+            self.assertEqual([await samples.__anext__() for _ in range(3)], [0.0, 0.0, 1.0])
+            await samples.aclose()
+        self.run_board(check)
+
+
 class UtilTests(unittest.TestCase):
 
     def test_to_two_bytes(self):
@@ -503,11 +1522,113 @@ class UtilTests(unittest.TestCase):
             itr.append(0)
         self.assertEqual(itr, str_to_two_byte_iter(string))
 
+    def test_sample_buffer(self):
+        buf = SampleBuffer(3)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(list(buf.last()[0]), [])
+        for i in range(5):
+            buf.append(i, i / 10)
+        self.assertEqual(len(buf), 3)
+        values, timestamps = buf.last(2)
+        self.assertEqual(list(values), [3, 4])
+        self.assertEqual(list(timestamps), [0.3, 0.4])
+        self.assertEqual(list(buf.last(10)[0]), [2, 3, 4])
+        self.assertRaises(ValueError, SampleBuffer, 0)
+
+    def test_sample_buffer_to_numpy(self):
+        try:
+            import numpy  # NOQA
+        except ImportError:
+            self.skipTest('needs numpy')
+        buf = SampleBuffer(3)
+        buf.append(7, 1.5)
+        values, timestamps = buf.to_numpy()
+        self.assertEqual(values.tolist(), [7])
+        self.assertEqual(timestamps.tolist(), [1.5])
+
+    def test_windows(self):
+        self.assertEqual(list(stream.windows(range(5), 2)), [[0, 1], [2, 3]])
+        self.assertEqual(list(stream.windows(range(4), 3, 1)), [[0, 1, 2], [1, 2, 3]])
+        self.assertEqual(list(stream.windows(range(10), 2, 3)), [[0, 1], [3, 4], [6, 7]])
+
     def test_break_to_bytes(self):
         self.assertEqual(break_to_bytes(200), (200,))
         self.assertEqual(break_to_bytes(800), (200, 4))
         self.assertEqual(break_to_bytes(802), (2, 2, 200))
 
+    def test_find_boards(self):
+        base_dir = tempfile.mkdtemp()
+        for device in ('tty.usbserial-1', 'tty.usbserial-2', 'ttyS0'):
+            open(os.path.join(base_dir, device), 'w').close()
+        pyfirmata.pyfirmata.serial.Serial = FirmwareSerial
+        try:
+            found = util.find_boards(base_dir, layout=BOARDS['arduino'], timeout=1)
+            self.assertEqual([f.board.sp.port for f in found],
+                             [os.path.join(base_dir, 'tty.usbserial-1'),
+                              os.path.join(base_dir, 'tty.usbserial-2')])
+            self.assertEqual(found[0][1:3], ('Test', (2, 5)))
+            self.assertEqual(found[0].fingerprint, util.layout_fingerprint(BOARDS['arduino']))
+            found = util.find_boards(pattern=os.path.join(base_dir, 'ttyS*'),
+                                     layout=BOARDS['arduino'], timeout=1)
+            self.assertEqual(len(found), 1)
+            self.assertRaises(IOError, util.get_the_board, BOARDS['arduino'], base_dir)
+
+            # Ports without Firmata are probed at the same time
+            pyfirmata.pyfirmata.serial.Serial = mockup.MockupSerial
+            start = time.time()
+            self.assertEqual(util.find_boards(base_dir, identifier='tty',
+                                              layout=BOARDS['arduino'], timeout=0.2), [])
+            self.assertLess(time.time() - start, 0.5)
+        finally:
+            pyfirmata.pyfirmata.serial.Serial = serial.Serial
+            for device in os.listdir(base_dir):
+                os.remove(os.path.join(base_dir, device))
+            os.rmdir(base_dir)
+
+    def test_find_boards_failures(self):
+        opened = []
+
+        class FailingSerial(FirmwareSerial):
+            def __init__(self, port, baudrate, timeout=None):
+                if port.endswith('2'):
+                    raise RuntimeError("Broken driver")
+                super(FailingSerial, self).__init__(port, baudrate, timeout)
+                self.closed = False
+                opened.append(self)
+
+            def close(self):
+                self.closed = True
+
+        base_dir = tempfile.mkdtemp()
+        for device in ('tty.usbserial-1', 'tty.usbserial-2'):
+            open(os.path.join(base_dir, device), 'w').close()
+        pyfirmata.pyfirmata.serial.Serial = FailingSerial
+        try:
+            # An invalid layout makes the setup fail after opening the port
+            self.assertEqual(util.find_boards(base_dir, layout={'analog': ()}, timeout=1), [])
+        finally:
+            pyfirmata.pyfirmata.serial.Serial = serial.Serial
+            for device in os.listdir(base_dir):
+                os.remove(os.path.join(base_dir, device))
+            os.rmdir(base_dir)
+        self.assertEqual([sp.closed for sp in opened], [True])
+
+    def test_parse_capabilities(self):
+        data = [0x7F, 0, 1, 1, 1, 3, 10, 4, 14, 0x7F, 0, 1, 2, 12, 0x7F]
+        capabilities = parse_capabilities(data)
+        self.assertEqual(capabilities, ({}, {0: 1, 1: 1, 3: 10, 4: 14}, {0: 1, 2: 12}))
+        layout = capabilities_to_layout(capabilities, parse_analog_mapping([0x7F, 0x7F, 3]))
+        self.assertEqual(layout['digital'], (0, 1))
+        self.assertEqual(layout['analog'], (3,))
+        self.assertEqual(layout['pwm'], (1,))
+        self.assertEqual(layout['servo'], (1,))
+        self.assertEqual(layout['disabled'], (0,))
+        self.assertEqual(layout['analog_resolution'], 12)
+        self.assertEqual(layout['analog_mapping'], (None, None, 3))
+        self.assertEqual(layout['capabilities'][1], ((0, 1), (1, 1), (3, 10), (4, 14)))
+        # Without the mapping analog pins are numbered in order
+        self.assertEqual(capabilities_to_layout(capabilities)['analog'], (0,))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)